@@ -119,78 +119,341 @@ def cer(reference, hypothesis, ignore_case=False, remove_space=False):
     cer = float(edit_distance) / ref_len
     return cer
 
+
+def _batch_levenshtein_distance(refs, hyps):
+    """Levenshtein distance for every (ref, hyp) pair of a batch at once.
+
+    Tokens are mapped to integers and padded, then the distance matrix is
+    filled one row at a time for the whole batch. The insertion chain inside
+    a row is resolved with a running minimum instead of a loop over columns.
+    """
+    batch_size = len(refs)
+    ref_lens = np.array([len(ref) for ref in refs], dtype=np.int64)
+    hyp_lens = np.array([len(hyp) for hyp in hyps], dtype=np.int64)
+    distance = np.zeros(batch_size, dtype=np.int32)
+    if batch_size == 0:
+        return distance
+
+    m = int(ref_lens.max())
+    n = int(hyp_lens.max())
+
+    # padding values never match each other or a real token
+    vocab = {}
+    ref_ids = np.full((batch_size, m), -1, dtype=np.int64)
+    hyp_ids = np.full((batch_size, n), -2, dtype=np.int64)
+    for b in range(batch_size):
+        ref_ids[b, :ref_lens[b]] = [vocab.setdefault(t, len(vocab)) for t in refs[b]]
+        hyp_ids[b, :hyp_lens[b]] = [vocab.setdefault(t, len(vocab)) for t in hyps[b]]
+
+    cols = np.arange(n + 1, dtype=np.int32)
+    row = np.tile(cols, (batch_size, 1))
+    finished = ref_lens == 0
+    distance[finished] = hyp_lens[finished]
+
+    for i in range(1, m + 1):
+        mismatch = ref_ids[:, i - 1, None] != hyp_ids
+        candidate = np.empty_like(row)
+        candidate[:, 0] = i
+        candidate[:, 1:] = np.minimum(row[:, :-1] + mismatch, row[:, 1:] + 1)
+        # insertions: row[j] = min over k <= j of candidate[k] + (j - k)
+        row = np.minimum.accumulate(candidate - cols, axis=1) + cols
+        finished = ref_lens == i
+        distance[finished] = row[finished, hyp_lens[finished]]
+
+    return distance
+
+
+def batch_word_errors(references, hypotheses, ignore_case=False, delimiter=' '):
+
+    if ignore_case == True:
+        references = [reference.lower() for reference in references]
+        hypotheses = [hypothesis.lower() for hypothesis in hypotheses]
+
+    ref_words = [reference.split(delimiter) for reference in references]
+    hyp_words = [hypothesis.split(delimiter) for hypothesis in hypotheses]
+
+    edit_distances = _batch_levenshtein_distance(ref_words, hyp_words)
+    return [float(d) for d in edit_distances], [len(words) for words in ref_words]
+
+
+def batch_char_errors(references, hypotheses, ignore_case=False, remove_space=False):
+
+    if ignore_case == True:
+        references = [reference.lower() for reference in references]
+        hypotheses = [hypothesis.lower() for hypothesis in hypotheses]
+
+    join_char = ' '
+    if remove_space == True:
+        join_char = ''
+
+    references = [join_char.join(filter(None, r.split(' '))) for r in references]
+    hypotheses = [join_char.join(filter(None, h.split(' '))) for h in hypotheses]
+
+    edit_distances = _batch_levenshtein_distance(references, hypotheses)
+    return [float(d) for d in edit_distances], [len(reference) for reference in references]
+
+
+def batch_wer(references, hypotheses, ignore_case=False, delimiter=' '):
+
+    edit_distances, ref_lens = batch_word_errors(references, hypotheses, ignore_case,
+                                                 delimiter)
+
+    if 0 in ref_lens:
+        raise ValueError("Reference's word number should be greater than 0.")
+
+    return [edit_distance / ref_len for edit_distance, ref_len in zip(edit_distances, ref_lens)]
+
+
+def batch_cer(references, hypotheses, ignore_case=False, remove_space=False):
+
+    edit_distances, ref_lens = batch_char_errors(references, hypotheses, ignore_case,
+                                                 remove_space)
+
+    if 0 in ref_lens:
+        raise ValueError("Length of reference should be greater than 0.")
+
+    return [edit_distance / ref_len for edit_distance, ref_len in zip(edit_distances, ref_lens)]
+
+"""**Text Similarity and Word Alignment**
+
+One place for the scores shown to patients and written to evaluation reports. Character edit
+distance uses Myers' bit-parallel algorithm: the reference is a bit vector (a Python int, so any
+length) and every hypothesis symbol updates a whole DP column with a few integer operations.
+Word-level alignment fills the DP matrix row by row like `_batch_levenshtein_distance` and walks
+back through it to list the substituted, inserted and deleted words.
+"""
+
+def edit_distance(reference, hypothesis):
+    """Levenshtein distance between two strings (or token sequences), bit-parallel over the reference"""
+    m = len(reference)
+    if m == 0:
+        return len(hypothesis)
+    peq = {}
+    for i, token in enumerate(reference):
+        peq[token] = peq.get(token, 0) | (1 << i)
+    mask = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    for token in hypothesis:
+        eq = peq.get(token, 0)
+        xv = eq | mv
+        xh = ((((eq & pv) + pv) & mask) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & mask
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+    return score
+
+def word_alignment(reference_words, hypothesis_words):
+    """Minimal edit script as a list of (op, reference word, hypothesis word),
+    op is 'equal', 'substitute', 'delete' (word not read) or 'insert' (extra word)"""
+    m, n = len(reference_words), len(hypothesis_words)
+    vocab = {}
+    ref_ids = np.array([vocab.setdefault(w, len(vocab)) for w in reference_words], dtype=np.int64)
+    hyp_ids = np.array([vocab.setdefault(w, len(vocab)) for w in hypothesis_words], dtype=np.int64)
+
+    cols = np.arange(n + 1, dtype=np.int32)
+    distance = np.empty((m + 1, n + 1), dtype=np.int32)
+    distance[0] = cols
+    for i in range(1, m + 1):
+        candidate = np.empty(n + 1, dtype=np.int32)
+        candidate[0] = i
+        candidate[1:] = np.minimum(distance[i - 1, :-1] + (ref_ids[i - 1] != hyp_ids), distance[i - 1, 1:] + 1)
+        distance[i] = np.minimum.accumulate(candidate - cols) + cols
+
+    ops = []
+    i, j = m, n
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and distance[i, j] == distance[i - 1, j - 1] + (ref_ids[i - 1] != hyp_ids[j - 1]):
+            op = 'equal' if ref_ids[i - 1] == hyp_ids[j - 1] else 'substitute'
+            ops.append((op, reference_words[i - 1], hypothesis_words[j - 1]))
+            i, j = i - 1, j - 1
+        elif i > 0 and distance[i, j] == distance[i - 1, j] + 1:
+            ops.append(('delete', reference_words[i - 1], None))
+            i -= 1
+        else:
+            ops.append(('insert', None, hypothesis_words[j - 1]))
+            j -= 1
+    return ops[::-1]
+
+def text_similarity(reference, hypothesis):
+    """All scores for one (reference, hypothesis) pair, both already normalized.
+
+    ratio is 1 - char edit distance / longer length, so it moves together with cer.
+    """
+    char_errors = edit_distance(reference, hypothesis)
+    alignment = word_alignment(reference.split(), hypothesis.split())
+    words = len(reference.split())
+    word_errors = sum(op != 'equal' for op, _, _ in alignment)
+    return {
+        'ratio': 1 - char_errors / max(1, len(reference), len(hypothesis)),
+        'cer': char_errors / max(1, len(reference)),
+        'wer': word_errors / max(1, words),
+        'char_errors': char_errors,
+        'chars': len(reference),
+        'word_errors': word_errors,
+        'words': words,
+        'word_accuracy': sum(op == 'equal' for op, _, _ in alignment) / max(1, words),
+        'alignment': alignment,
+    }
+
+def format_alignment(alignment):
+    """Reference with misread words marked: [read→heard], [-missed], [+extra]"""
+    parts = []
+    for op, ref_word, hyp_word in alignment:
+        if op == 'equal':
+            parts.append(ref_word)
+        elif op == 'substitute':
+            parts.append(f'[{ref_word}→{hyp_word}]')
+        elif op == 'delete':
+            parts.append(f'[-{ref_word}]')
+        else:
+            parts.append(f'[+{hyp_word}]')
+    return ' '.join(parts)
+
 class TextTransform:
-    """Maps characters to integers and vice versa"""
-    def __init__(self):
-        char_list = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя ,.?!@#$%^&*()-=_+ \n"
-        # Create char_map with both lower and upper case letters
-        self.char_map = {char: index for index, char in enumerate(char_list + char_list.upper())}
-        self.index_map = {index: char for index, char in enumerate(char_list + char_list.upper())}
+    """Fixed vocabulary: maps whole batches of strings to padded label tensors and back.
+
+    The model has n_class outputs and CTC uses `blank` as the blank label, so the characters take
+    the remaining n_class - 1 indices. Text is normalized on the way in: upper case is folded to
+    lower case, ё to е, any whitespace becomes a single space, everything else is dropped.
+    Encoding goes through a NumPy lookup table indexed by Unicode code point.
+    """
+    def __init__(self, chars="абвгдежзийклмнопрстуфхцчшщъыьэюя ", n_class=34, blank=28):
+        if len(chars) != n_class - 1 or len(set(chars)) != len(chars):
+            raise ValueError(f'{len(chars)} distinct characters do not fit {n_class} classes with a blank')
+        if not 0 <= blank < n_class:
+            raise ValueError(f'blank label {blank} is outside of {n_class} classes')
+        self.chars = chars
+        self.n_class = n_class
+        self.blank = blank
+        labels = [i if i < blank else i + 1 for i in range(len(chars))]  # skip the blank index
+        self.char_map = dict(zip(chars, labels))
+        self.index_map = dict(zip(labels, chars))
+        self.space_label = self.char_map[' ']
+
+        aliases = {c.upper(): c for c in chars if c.upper() != c}
+        aliases.update({'ё': 'е', 'Ё': 'е'})
+        aliases.update({c: ' ' for c in '\t\n\r\x0b\x0c\xa0'})
+        mapping = dict(self.char_map, **{alias: self.char_map[c] for alias, c in aliases.items()})
+        # code point -> label, -1 drops the character; the last entry catches everything above
+        self._encode_table = np.full(max(map(ord, mapping)) + 2, -1, dtype=np.int32)
+        for c, label in mapping.items():
+            self._encode_table[ord(c)] = label
+        # label -> code point, index -1 (dropped / padding) maps to 0 and is removed
+        self._decode_table = np.zeros(n_class + 1, dtype=np.uint32)
+        for label, c in self.index_map.items():
+            self._decode_table[label] = ord(c)
+
+    def encode_batch(self, texts):
+        """(batch, max_len) int32 label tensor padded with 0, and the list of label lengths"""
+        texts = [str(text) for text in texts]
+        codes = np.frombuffer(''.join(texts).encode('utf-32-le'), dtype=np.uint32)
+        labels = self._encode_table[np.minimum(codes, len(self._encode_table) - 1)]
+        text_ids = np.repeat(np.arange(len(texts)), [len(text) for text in texts])
+        keep = labels >= 0
+        labels, text_ids = labels[keep], text_ids[keep]
+
+        # collapse runs of spaces, then drop the ones at the start and the end of a text
+        space = labels == self.space_label
+        same_text = text_ids[1:] == text_ids[:-1]
+        keep = ~(space & np.r_[False, space[:-1] & same_text])
+        labels, text_ids = labels[keep], text_ids[keep]
+        space = labels == self.space_label
+        same_text = text_ids[1:] == text_ids[:-1]
+        keep = ~(space & (np.r_[True, ~same_text] | np.r_[~same_text, True]))
+        labels, text_ids = labels[keep], text_ids[keep]
+
+        lengths = np.bincount(text_ids, minlength=len(texts))
+        positions = np.arange(len(labels)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        padded = np.zeros((len(texts), lengths.max(initial=0)), dtype=np.int32)
+        padded[text_ids, positions] = labels
+        return torch.from_numpy(padded), lengths.tolist()
+
+    def decode_batch(self, labels, lengths=None):
+        """Strings for a (batch, time) array of labels, -1 entries and entries past `lengths` are skipped"""
+        labels = np.asarray(labels.cpu() if torch.is_tensor(labels) else labels, dtype=np.int64)
+        codes = self._decode_table[labels]
+        if lengths is not None:
+            codes[np.arange(labels.shape[1]) >= np.asarray(lengths)[:, None]] = 0
+        return [row[row > 0].tobytes().decode('utf-32-le') for row in codes]
+
+    def normalize_batch(self, texts):
+        labels, lengths = self.encode_batch(texts)
+        return self.decode_batch(labels, lengths)
 
     def text_to_int(self, text):
         """ Use a character map and convert text to an integer sequence """
-        int_sequence = []
-        for c in text:
-            if c != '':
-                ch = self.char_map[c]
-            int_sequence.append(ch)
-        return int_sequence
+        labels, _ = self.encode_batch([text])
+        return labels[0].tolist()
 
     def int_to_text(self, labels):
         """ Use a character map and convert integer labels to an text sequence """
-        string = []
-        for i in labels:
-            string.append(self.index_map[i])
-        return ''.join(string)
+        return self.decode_batch([labels])[0] if len(labels) else ''
+
+mel_params = {"sample_rate": 16000, "n_fft": 400, "hop_length": 200, "n_mels": 128}
 
 train_audio_transforms = nn.Sequential(
-    torchaudio.transforms.MelSpectrogram(sample_rate=16000, n_mels=128),
+    torchaudio.transforms.MelSpectrogram(**mel_params),
     torchaudio.transforms.FrequencyMasking(freq_mask_param=30),
     torchaudio.transforms.TimeMasking(time_mask_param=100)
 )
 
-valid_audio_transforms = torchaudio.transforms.MelSpectrogram()
+valid_audio_transforms = torchaudio.transforms.MelSpectrogram(**mel_params)
+
+# Same pipelines for mel spectrograms that were already computed (see FeatureCache)
+train_feature_transforms = train_audio_transforms[1:]
+valid_feature_transforms = nn.Identity()
 
 text_transform = TextTransform()
 
-def data_processing(data, data_type="train"):
+def pad_spectrograms(spectrograms):
+    """Pads a list of (time, n_mels) spectrograms into a (batch, 1, n_mels, time) model input"""
+    return nn.utils.rnn.pad_sequence(spectrograms, batch_first=True).unsqueeze(1).transpose(2, 3)
+
+def data_processing(data, data_type="train", precomputed=False):
     spectrograms = []
-    labels = []
     input_lengths = []
-    label_lengths = []
     for (waveform, utterance) in data:
         if data_type == 'train':
-            spec = train_audio_transforms(waveform).squeeze(0).transpose(0, 1)
+            transforms = train_feature_transforms if precomputed else train_audio_transforms
         elif data_type == 'valid':
-            spec = valid_audio_transforms(waveform).squeeze(0).transpose(0, 1)
+            transforms = valid_feature_transforms if precomputed else valid_audio_transforms
         else:
             raise Exception('data_type should be train or valid')
+        spec = transforms(waveform).squeeze(0).transpose(0, 1)
         spectrograms.append(spec)
-        label = torch.Tensor(text_transform.text_to_int(utterance))
-        labels.append(label)
         input_lengths.append(spec.shape[0]//4)
-        label_lengths.append(len(label))
 
-    spectrograms1 = nn.utils.rnn.pad_sequence(spectrograms, batch_first=True).unsqueeze(1).transpose(2, 3)
+    spectrograms1 = pad_spectrograms(spectrograms)
 
-    labels = nn.utils.rnn.pad_sequence(labels, batch_first=True)
+    labels, label_lengths = text_transform.encode_batch([utterance for _, utterance in data])  # int32, padded
 
     return spectrograms1, labels, input_lengths, label_lengths
 
 
-def GreedyDecoder(output, labels, label_lengths, blank_label=28, collapse_repeated=True):
+def decode_predictions(output, output_lengths=None, blank_label=28, collapse_repeated=True):
+    """Greedy CTC decoding of (batch, time, n_class) model output, no targets needed"""
     arg_maxes = torch.argmax(output, dim=2)
-    decodes = []
-    targets = []
-    for i, args in enumerate(arg_maxes):
-        decode = []
-        targets.append(text_transform.int_to_text(labels[i][:label_lengths[i]].tolist()))
-        for j, index in enumerate(args):
-            if index != blank_label:
-                if collapse_repeated and j != 0 and index == args[j -1]:
-                    continue
-                decode.append(index.item())
-        decodes.append(text_transform.int_to_text(decode))
+    keep = arg_maxes != blank_label
+    if collapse_repeated:
+        keep[:, 1:] &= arg_maxes[:, 1:] != arg_maxes[:, :-1]
+    if output_lengths is not None:
+        lengths = torch.as_tensor(output_lengths, device=arg_maxes.device)
+        keep &= torch.arange(arg_maxes.shape[1], device=arg_maxes.device) < lengths[:, None]
+    # one device-to-host transfer for the whole batch, dropped frames are marked with -1
+    return text_transform.decode_batch(torch.where(keep, arg_maxes, -1).cpu().numpy())
+
+
+def GreedyDecoder(output, labels, label_lengths, blank_label=28, collapse_repeated=True, output_lengths=None):
+    decodes = decode_predictions(output, output_lengths, blank_label, collapse_repeated)
+    targets = text_transform.decode_batch(labels, label_lengths)
     return decodes, targets
 
 """**Layer Normalization and Residual Connections in Speech Recognition Network**"""
@@ -299,55 +562,396 @@ import torch
 
 """**Load the data**"""
 
-file = pd.read_excel(r'/content/drive/MyDrive/Dataset_PC/RSDA Dataset v5/Data.xlsx')
-file['text'] = file['text'].str.replace(r'[^а-яА-ЯёЁ\s]', '', regex=True)
+DATA_FILE_PATH = r'/content/drive/MyDrive/Dataset_PC/RSDA Dataset v5/Data.xlsx'
+
+file = pd.read_excel(DATA_FILE_PATH)
+file['text'] = text_transform.normalize_batch(file['text'].fillna(''))
 y = list(file['text'])  # Assuming 'text' corresponds to your audio files
 ids = list(file['id'])   # Assuming the first column is 'id'
 
 """Directory containing audio files"""
 
 dir_name = r"/content/drive/MyDrive/Dataset_PC/RSDA Dataset v5/Speaker_3"
-files_in_dir = os.listdir(dir_name)
+speaker_dirs = [dir_name]  # Add more speaker directories to train on them too
+
+"""**Distributed launch**
 
-X = []
-filtered_y = []  # To hold corresponding y values
-filtered_ids = []  # To hold corresponding ids
+Under torchrun every rank runs the whole script, so the process group is joined here, before any
+data is prepared. Shared files (ingested audio, manifest, feature cache, LM) are written by rank 0
+only; in `rank_zero_first()` the other ranks wait at a barrier and then read what rank 0 wrote.
+Without torchrun this is a single process with rank 0.
+"""
 
-# Initialize a counter to keep track of the number of files processed
-file_count = 0
-max_files = 10  # Set the maximum number of files to process
+import contextlib
+import torch.distributed as dist
+
+def setup_distributed():
+    """Joins the torchrun process group, returns (rank, world_size), (0, 1) when not launched by torchrun"""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+    dist.init_process_group('gloo')
+    # split the cores between the processes on this machine instead of oversubscribing them
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    return dist.get_rank(), world_size
+
+@contextlib.contextmanager
+def rank_zero_first():
+    """Rank 0 runs the block first, the other ranks run it once rank 0 is done"""
+    if dist_world_size > 1 and dist_rank != 0:
+        dist.barrier()
+    yield
+    if dist_world_size > 1 and dist_rank == 0:
+        dist.barrier()
+
+dist_rank, dist_world_size = setup_distributed()
+
+"""**Audio decoding**
+
+soundfile decodes wav/flac/ogg natively (including OGG/Opus voice notes, libsndfile >= 1.0.29)
+and torchaudio resamples in C++; librosa (and its audioread fallback) is only used for files
+libsndfile can't read.
+"""
 
-for e in range(len(ids)):  # Iterate through all ids
-    if file_count >= max_files:  # Check if the maximum number of files has been reached
-        break  # Exit the loop if the limit is reached
+import functools
+import io
+import soundfile as sf
+
+@functools.lru_cache(maxsize=None)
+def _resampler(orig_sr, sr):
+    """Resample transform with its filter kernel computed once per rate pair"""
+    return torchaudio.transforms.Resample(orig_sr, sr)
+
+def _decode_audio(source, sr):
+    sampl, file_sr = sf.read(source, dtype='float32')
+    if sampl.ndim > 1:
+        sampl = sampl.mean(axis=1)
+    if file_sr != sr:
+        sampl = _resampler(file_sr, sr)(torch.from_numpy(sampl)).numpy()
+    return sampl
+
+def load_audio(file_path, sr=16000):
+    """Decode an audio file to a mono float32 array at the given sample rate"""
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(file_path)
+    try:
+        return _decode_audio(file_path, sr)
+    except RuntimeError:
+        return librosa.load(file_path, sr=sr)[0]
 
-    file_name = f'{ids[e]}.wav'
-    file_path = os.path.join(dir_name, file_name)  # Create the full file path
+def load_audio_bytes(audio_bytes, sr=16000):
+    """Same as load_audio for a file that is already in memory, nothing is written to disk"""
     try:
-        # Load the audio file
-        sampl = librosa.load(file_path, sr=16000)[0]
-        sampl = sampl[np.newaxis, :]  # Add a new axis
-        X.append(torch.Tensor(sampl))
-        filtered_y.append(y[e])  # Append the corresponding text
-        filtered_ids.append(ids[e])  # Append the corresponding id
+        return _decode_audio(io.BytesIO(audio_bytes), sr)
+    except RuntimeError:
+        # e.g. m4a, decoded in-process by torchaudio's ffmpeg bindings
+        waveform, file_sr = torchaudio.load(io.BytesIO(audio_bytes))
+        return _resampler(file_sr, sr)(waveform.mean(dim=0)).numpy()
+
+"""**Voice Activity Detection**
+
+Clinical reading tasks have long silences before and after the phrase. Frames are classified by
+short-time energy relative to the loudest frame and to the noise floor, plus the zero-crossing
+rate so that quiet fricatives (с, ш, ф) are kept. Both are computed for all frames at once from cumulative sums.
+`trim` mode cuts leading and trailing silence, `segment` mode also removes inner pauses longer
+than `min_silence_ms`. The same function and `vad_params` are used by the training datasets
+and by the bot.
+"""
+
+VAD_ENABLED = True
+vad_params = {
+    "mode": "trim",  # "trim" or "segment"
+    "frame_ms": 25,
+    "hop_ms": 10,
+    "energy_db": -40,  # speech is louder than (loudest frame + energy_db)
+    "zcr_threshold": 0.25,  # frames up to 15 dB quieter than that still count if they cross zero this often
+    "floor_db": -60,  # absolute level (dBFS) below which a frame is always silence
+    "noise_margin_db": 6,  # and so is a frame within this of the noise floor (quietest 10% of frames)
+    "padding_ms": 150,  # context kept around speech
+    "min_silence_ms": 400,  # segment mode: shorter pauses are kept
+}
+
+def speech_frames(samples, sr=16000, params=vad_params):
+    """Boolean speech mask over frames, plus the frame and hop sizes in samples"""
+    frame = int(sr * params['frame_ms'] / 1000)
+    hop = int(sr * params['hop_ms'] / 1000)
+    if len(samples) < frame:
+        return np.ones(1, dtype=bool), frame, hop
+    starts = np.arange(0, len(samples) - frame + 1, hop)
+    power = np.concatenate(([0.0], np.cumsum(np.square(samples, dtype=np.float64))))
+    db = 10 * np.log10((power[starts + frame] - power[starts]) / frame + 1e-10)
+    signs = np.signbit(samples)
+    crossings = np.concatenate(([0], np.cumsum(signs[1:] != signs[:-1])))
+    zcr = (crossings[starts + frame - 1] - crossings[starts]) / frame
+
+    floor = max(params['floor_db'], np.percentile(db, 10) + params['noise_margin_db'])
+    threshold = max(db.max() + params['energy_db'], floor)
+    fricative = (db > threshold - 15) & (zcr > params['zcr_threshold'])
+    return ((db > threshold) | fricative) & (db > floor), frame, hop
+
+def remove_silence(samples, sr=16000, params=vad_params):
+    """Samples without the silence found by speech_frames, unchanged if no speech is found"""
+    speech, frame, hop = speech_frames(samples, sr, params)
+    if not speech.any():
+        return samples
+    pad = round(params['padding_ms'] / params['hop_ms'])
+    if params['mode'] == 'trim':
+        idx = np.flatnonzero(speech)
+        return samples[max(0, (idx[0] - pad) * hop):(idx[-1] + pad) * hop + frame]
+
+    # dilation by `pad` frames on each side; 'same' would return the kernel length for short clips
+    keep = np.convolve(speech, np.ones(2 * pad + 1), mode='full')[pad:pad + len(speech)] > 0
+    # fill inner pauses shorter than min_silence_ms
+    changes = np.diff(np.concatenate(([1], keep.astype(np.int8), [1])))
+    gap_starts, gap_ends = np.flatnonzero(changes == -1), np.flatnonzero(changes == 1)
+    short = (gap_ends - gap_starts) * params['hop_ms'] < params['min_silence_ms']
+    short &= (gap_starts > 0) & (gap_ends < len(keep))
+    fill = np.zeros(len(keep) + 1, dtype=np.int32)
+    np.add.at(fill, gap_starts[short], 1)
+    np.add.at(fill, gap_ends[short], -1)
+    keep |= np.cumsum(fill[:-1]) > 0
+
+    sample_keep = np.repeat(keep, hop)[:len(samples)]
+    sample_keep = np.concatenate((sample_keep, np.full(len(samples) - len(sample_keep), keep[-1])))
+    return samples[sample_keep]
+
+def vad_report(manifest, model=None, max_files=200, params=vad_params):
+    """Fraction of audio removed by remove_silence and the speedup of mel + model forward it gives"""
+    if model is None:
+        model = SpeechRecognitionModel1(34)  # only the timing matters
+    model.eval()
+    total, kept = 0, 0
+    full_seconds, vad_seconds = 0.0, 0.0
+    with torch.no_grad():
+        for path in list(manifest['path'])[:max_files]:
+            samples = load_audio(path)
+
+            start = time.perf_counter()
+            model(valid_audio_transforms(torch.from_numpy(samples).unsqueeze(0)).unsqueeze(0))
+            full_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            trimmed = remove_silence(samples, params=params)
+            model(valid_audio_transforms(torch.from_numpy(trimmed).unsqueeze(0)).unsqueeze(0))
+            vad_seconds += time.perf_counter() - start
+
+            total += len(samples)
+            kept += len(trimmed)
+    report = {'files': min(max_files, len(manifest)), 'removed_fraction': 1 - kept / max(1, total),
+              'speedup': full_seconds / max(vad_seconds, 1e-9)}
+    print(f"VAD ({params['mode']}) removed {report['removed_fraction']:.1%} of the audio in {report['files']} files, "
+          f"mel + forward speedup {report['speedup']:.2f}x")
+    return report
+
+"""**Parallel ingestion of speaker directories**
+
+Decodes and resamples every `{id}.wav` of a speaker directory to 16 kHz float wav files in a
+process pool. Files already ingested are skipped, so the cell can be re-run after an interruption.
+Missing ids and files that could not be decoded are written to `ingest_report.json` in the output directory.
+"""
+
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-        file_count += 1  # Increment the counter after successfully processing a file
+INGEST_DIR = None  # e.g. r"/content/drive/MyDrive/Dataset_PC/RSDA Dataset v5/16k", None trains on the original files
+INGEST_WORKERS = os.cpu_count()
 
+def _ingest_file(task):
+    """Returns (id, output path or None, duration, error), one bad file must not stop the pool"""
+    file_id, src_path, dst_path, sr = task
+    if os.path.exists(dst_path):
+        return file_id, dst_path, sf.info(dst_path).duration, None
+    try:
+        sampl = load_audio(src_path, sr)
     except FileNotFoundError:
-        print(f"File {file_name} not found, skipping text: '{y[e]}'")
-        # Skip the text as the audio file is missing
+        return file_id, None, 0.0, None
+    except Exception as e:  # sf.LibsndfileError (a RuntimeError) or whatever the librosa fallback raises
+        return file_id, None, 0.0, f'{type(e).__name__}: {e}'
+    # written under a temporary name, so an interrupted run never leaves a truncated file that looks ingested
+    tmp_path = dst_path + '.tmp'
+    sf.write(tmp_path, sampl, sr, format='WAV', subtype='FLOAT')
+    os.replace(tmp_path, dst_path)
+    return file_id, dst_path, len(sampl) / sr, None
+
+def ingest_speaker_dir(speaker_dir, ids, texts, output_dir, num_workers=INGEST_WORKERS, sr=16000):
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(file_id, os.path.join(speaker_dir, f'{file_id}.wav'), os.path.join(output_dir, f'{file_id}.wav'), sr)
+             for file_id in ids]
+
+    rows, missing, failed = [], [], []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        results = pool.map(_ingest_file, tasks, chunksize=8)
+        for (file_id, dst_path, duration, error), text, task in zip(results, texts, tasks):
+            if error is not None:
+                print(f"File {file_id}.wav could not be decoded ({error}), skipping text: '{text}'")
+                failed.append({'id': file_id, 'path': task[1], 'text': text, 'error': error})
+            elif dst_path is None:
+                print(f"File {file_id}.wav not found, skipping text: '{text}'")
+                missing.append({'id': file_id, 'path': task[1], 'text': text})
+            else:
+                rows.append({'id': file_id, 'path': dst_path, 'text': text, 'duration': duration})
+    elapsed = time.perf_counter() - start
+
+    audio_seconds = sum(row['duration'] for row in rows)
+    report = {
+        'speaker_dir': speaker_dir,
+        'output_dir': output_dir,
+        'num_workers': num_workers,
+        'files': len(rows),
+        'audio_seconds': audio_seconds,
+        'elapsed_seconds': elapsed,
+        'files_per_sec': len(rows) / elapsed if elapsed else 0.0,
+        'audio_seconds_per_sec': audio_seconds / elapsed if elapsed else 0.0,
+        'missing': missing,
+        'failed': failed,
+    }
+    with open(os.path.join(output_dir, 'ingest_report.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    print(f"Ingested {len(rows)} files from {speaker_dir} with {num_workers} workers in {elapsed:.1f} s: "
+          f"{report['files_per_sec']:.1f} files/sec, {report['audio_seconds_per_sec']:.1f} audio-sec/sec, "
+          f"{len(missing)} missing, {len(failed)} failed")
+    return pd.DataFrame(rows, columns=['id', 'path', 'text', 'duration']), report
+
+if INGEST_DIR is not None:
+    ingested_dirs = []
+    with rank_zero_first():
+        for speaker_dir in speaker_dirs:
+            output_dir = os.path.join(INGEST_DIR, os.path.basename(speaker_dir))
+            if dist_rank == 0:
+                ingest_speaker_dir(speaker_dir, ids, y, output_dir)
+            ingested_dirs.append(output_dir)
+    speaker_dirs = ingested_dirs
+
+"""**Build the dataset manifest**
+
+Only (id, path, text, duration, speech_duration) is kept in memory; audio is decoded later by
+AudioDataset. `speech_duration` is the length left after `remove_silence` (equal to `duration`
+without VAD), it is what the batches are bucketed on. The train/test split is drawn once with
+SPLIT_SEED and stored in the `split` column, so every run (and every resume) trains and evaluates
+on the same utterances. The manifest is saved next to the data together with the parameters it
+was built from (speaker_dirs, max_files, INGEST_DIR, VAD, split) and rebuilt when Data.xlsx or
+any of them changes.
+"""
 
-"""Check the shapes of X and filtered_y"""
+import hashlib
+from sklearn.model_selection import train_test_split
 
-print(f"Length of X: {len(X)}")
-print(f"Length of filtered_y: {len(filtered_y)}")
+MANIFEST_PATH = r"/content/drive/MyDrive/Dataset_PC/RSDA Dataset v5/manifest.csv"
+MANIFEST_PARAMS_PATH = os.path.splitext(MANIFEST_PATH)[0] + '.json'
+max_files = None  # Set a number to only use the first files, None uses all of them
+TEST_SIZE = 0.1
+SPLIT_SEED = 7
 
-"""Check the shape of the first sample if it exists"""
+def _speech_duration(task):
+    """Seconds of audio AudioDataset will yield for a file, i.e. after remove_silence when `vad` is set"""
+    path, vad, sr = task
+    try:
+        sampl = load_audio(path, sr)
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+    if vad is not None:
+        sampl = remove_silence(sampl, sr, vad)
+    return len(sampl) / sr, None
+
+def build_manifest(speaker_dirs, ids, texts, max_files=None, vad=None, num_workers=INGEST_WORKERS, sr=16000):
+    rows = []
+    for speaker_dir in speaker_dirs:
+        files_in_dir = set(os.listdir(speaker_dir))
+        for e in range(len(ids)):  # Iterate through all ids
+            if max_files is not None and len(rows) >= max_files:
+                break
+
+            file_name = f'{ids[e]}.wav'
+            if file_name not in files_in_dir:
+                print(f"File {file_name} not found, skipping text: '{texts[e]}'")
+                continue  # Skip the text as the audio file is missing
+
+            file_path = os.path.join(speaker_dir, file_name)
+            rows.append({
+                'id': ids[e],
+                'path': file_path,
+                'text': texts[e],
+                'duration': librosa.get_duration(path=file_path),  # reads the header only
+            })
+
+    if vad is None:
+        for row in rows:
+            row['speech_duration'] = row['duration']
+    else:
+        # every file is decoded once to measure the speech VAD keeps
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = pool.map(_speech_duration, [(row['path'], vad, sr) for row in rows], chunksize=8)
+            kept = []
+            for row, (speech_duration, error) in zip(rows, results):
+                if error is not None:
+                    print(f"File {row['path']} could not be decoded ({error}), skipping text: '{row['text']}'")
+                    continue
+                row['speech_duration'] = speech_duration
+                kept.append(row)
+        rows = kept
+    return pd.DataFrame(rows, columns=['id', 'path', 'text', 'duration', 'speech_duration'])
+
+def assign_split(manifest, test_size=TEST_SIZE, seed=SPLIT_SEED):
+    """'train' or 'test' for every row, the same for the same manifest and seed"""
+    _, test = train_test_split(manifest, test_size=test_size, random_state=seed)
+    return np.where(manifest.index.isin(test.index), 'test', 'train')
+
+def split_digest(manifest):
+    """Hash of which files are in which split, stored in checkpoints to detect a changed split"""
+    pairs = sorted(zip(manifest['split'], manifest['path']))
+    return hashlib.sha1('\n'.join(f'{split}\t{path}' for split, path in pairs).encode()).hexdigest()[:16]
+
+def _saved_manifest_params(params_path=MANIFEST_PARAMS_PATH):
+    if not os.path.exists(params_path):
+        return None
+    with open(params_path) as f:
+        return json.load(f)
+
+manifest_params = {
+    'data_file': DATA_FILE_PATH,
+    'data_file_mtime': os.path.getmtime(DATA_FILE_PATH),
+    'speaker_dirs': list(speaker_dirs),
+    'max_files': max_files,
+    'ingest_dir': INGEST_DIR,
+    'vad': vad_params if VAD_ENABLED else None,
+    'test_size': TEST_SIZE,
+    'split_seed': SPLIT_SEED,
+}
+
+# the other ranks find the manifest rank 0 has just saved
+with rank_zero_first():
+    if os.path.exists(MANIFEST_PATH) and _saved_manifest_params() == manifest_params:
+        manifest = pd.read_csv(MANIFEST_PATH, keep_default_na=False)
+        print(f"Manifest loaded from {MANIFEST_PATH}")
+    else:
+        manifest = build_manifest(speaker_dirs, ids, y, max_files, vad=manifest_params['vad'])
+        manifest['split'] = assign_split(manifest)
+        manifest.to_csv(MANIFEST_PATH, index=False)
+        # written after the manifest, an interrupted save is rebuilt on the next run
+        with open(MANIFEST_PARAMS_PATH, 'w') as f:
+            json.dump(manifest_params, f, indent=2)
+        print(f"Manifest saved to {MANIFEST_PATH}")
+
+filtered_y = list(manifest['text'])  # To hold corresponding y values
+filtered_ids = list(manifest['id'])  # To hold corresponding ids
+
+"""Check the size of the manifest"""
 
-if X:
-    print("First audio shape:", X[0].shape)
+print(f"Length of manifest: {len(manifest)}")
+print(f"Total audio duration: {manifest['duration'].sum() / 3600:.2f} h "
+      f"({manifest['speech_duration'].sum() / 3600:.2f} h after silence removal)")
+
+"""Check the first sample if it exists"""
+
+if len(manifest):
+    print("First audio file:", manifest['path'].iloc[0], f"({manifest['duration'].iloc[0]:.2f} s)")
 else:
-    print("No audio files were loaded.")
+    print("No audio files were found.")
 
 """Create a new DataFrame with the filtered results"""
 
@@ -358,50 +962,247 @@ filtered_df = pd.DataFrame({
 
 """**load Excel file**"""
 
-filtered_df.to_excel(r'D:\RSDA Dataset v5\Adjusted_Data.xlsx', index=False)
-print("Adjusted DataFrame loaded succefully'.")
-
-"""Output the shape of the first audio sample"""
+if dist_rank == 0:
+    filtered_df.to_excel(r'D:\RSDA Dataset v5\Adjusted_Data.xlsx', index=False)
+    print("Adjusted DataFrame loaded succefully'.")
 
-if X:
-    print("Shape of first audio sample:", X[0].shape)
-else:
-    print("No audio samples to display.")
-
-X[0].shape
+train_manifest = manifest[manifest['split'] == 'train']
+test_manifest = manifest[manifest['split'] == 'test']
+manifest_split = split_digest(manifest)
+print(f"Train/test split {manifest_split}: {len(train_manifest)} / {len(test_manifest)} utterances")
 
-char_map = {"а": 0, "б": 1, "в": 2, "г": 3, "д": 4, "е": 5, "ё": 6, "ж": 7, "з": 8, "и": 9, "й": 10,
-            "к": 11, "л": 12, "м": 13, "н": 14, "о": 15, "п": 16, "р": 17, "с": 18, "т": 19, "у": 20,
-            "ф": 21, "ч": 22, "ц": 23, "ш": 24, "щ": 25, "ъ": 26, "ы": 27, "ь": 28, "э": 29, "ю": 30,
-            "я": 31, "х": 32, " ": 33,"\n": 34}
+"""**Custom Dataset for Audio-Text Pairing in Speech Recognition**"""
 
-def remove_characters(sentence):
-    # sentence = sentence.lower()
-    sentence = ''.join(filter(lambda x: x in char_map, sentence))
-    return sentence.replace('\n', '')
+from torch.utils.data import Dataset
 
-y = list(map(remove_characters, y))
+class AudioDataset(Dataset):
+    """Holds manifest metadata only, audio is decoded on access (in the DataLoader workers)"""
+    def __init__(self, manifest, sample_rate=16000, vad=VAD_ENABLED):
+        self.paths = list(manifest['path'])
+        self.text_list = list(manifest['text'])
+        self.sample_rate = sample_rate
+        self.vad = vad
 
-from sklearn.model_selection import train_test_split
+    def __len__(self):
+        return len(self.text_list)
 
-X_train, X_test, y_train, y_test = train_test_split(X, filtered_y, test_size=0.1)
+    def __getitem__(self, index):
+        sampl = load_audio(self.paths[index], sr=self.sample_rate)
+        if self.vad:
+            sampl = remove_silence(sampl, self.sample_rate)
+        audio = torch.Tensor(sampl[np.newaxis, :])
+        text = self.text_list[index]
+        return audio, text
 
-"""**Custom Dataset for Audio-Text Pairing in Speech Recognition**"""
+"""**Mel-Spectrogram Feature Cache**
 
-from torch.utils.data import Dataset
+Base mel spectrograms are computed once per utterance and stored in memory-mapped
+.npy shards, with an index from (audio file hash, mel and VAD parameters) to (shard, offset, frames).
+Only the masking augmentations run on every epoch.
+"""
 
-class AudioDataset(Dataset):
-    def __init__(self, audio_list, text_list):
-        self.audio_list = audio_list
+import hashlib
+import json
+
+FEATURE_CACHE_DIR = r"/content/drive/MyDrive/Dataset_PC/RSDA Dataset v5/feature_cache"  # None disables the cache
+
+class FeatureCache:
+    """Memory-mapped store of mel spectrograms keyed by audio content and transform parameters"""
+    def __init__(self, cache_dir, params=mel_params, shard_frames=500000, vad_params=None):
+        self.cache_dir = cache_dir
+        self.params = params
+        self.vad_params = vad_params  # None keeps the silence
+        self.shard_frames = shard_frames
+        digest_source = params if vad_params is None else dict(params, vad=vad_params)
+        self.params_digest = hashlib.sha1(json.dumps(digest_source, sort_keys=True).encode()).hexdigest()[:16]
+        self.mel = torchaudio.transforms.MelSpectrogram(**params)
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+        else:
+            index = {'shards': 0, 'entries': {}, 'files': {}}
+        self.index = index
+        self._index_changed = False
+        self._shards = {}
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def file_key(self, file_path):
+        """Content hash of the audio file combined with the mel parameters"""
+        stat = os.stat(file_path)
+        known = self.index['files'].get(file_path)
+        if known is not None and known[0] == stat.st_mtime and known[1] == stat.st_size:
+            file_hash = known[2]
+        else:
+            sha = hashlib.sha1()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            file_hash = sha.hexdigest()
+            self.index['files'][file_path] = [stat.st_mtime, stat.st_size, file_hash]
+            self._index_changed = True
+        return f'{file_hash}-{self.params_digest}'
+
+    def build(self, file_paths):
+        """Compute and store features missing from the cache, return one key per file"""
+        keys = [self.file_key(path) for path in file_paths]
+        pending, pending_frames, pending_keys = [], 0, set()
+        for i, key in enumerate(keys):
+            if key in self.index['entries'] or key in pending_keys:
+                continue
+            sampl = load_audio(file_paths[i], sr=self.params['sample_rate'])
+            if self.vad_params is not None:
+                sampl = remove_silence(sampl, self.params['sample_rate'], self.vad_params)
+            waveform = torch.Tensor(sampl[np.newaxis, :])
+            with torch.no_grad():
+                spec = self.mel(waveform).squeeze(0).transpose(0, 1)  # (time, n_mels)
+            pending.append((key, spec.numpy().astype(np.float32)))
+            pending_keys.add(key)
+            pending_frames += spec.shape[0]
+            if pending_frames >= self.shard_frames:
+                self._write_shard(pending)
+                pending, pending_frames = [], 0
+        if pending:
+            self._write_shard(pending)
+        if self._index_changed:  # a fully cached build writes nothing, e.g. on the non-zero DDP ranks
+            self._save_index()
+            self._index_changed = False
+        return keys
+
+    def _write_shard(self, items):
+        shard_id = self.index['shards']
+        shard_path = os.path.join(self.cache_dir, f'shard_{shard_id:05d}.npy')
+        offset = 0
+        for key, spec in items:
+            self.index['entries'][key] = [shard_id, offset, spec.shape[0]]
+            offset += spec.shape[0]
+        np.save(shard_path, np.concatenate([spec for _, spec in items], axis=0))
+        self.index['shards'] = shard_id + 1
+        self._index_changed = True
+        print(f'Feature cache: wrote {len(items)} spectrograms to {shard_path}')
+
+    def _save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def __getitem__(self, key):
+        shard_id, offset, frames = self.index['entries'][key]
+        if shard_id not in self._shards:
+            shard_path = os.path.join(self.cache_dir, f'shard_{shard_id:05d}.npy')
+            self._shards[shard_id] = np.load(shard_path, mmap_mode='r')
+        spec = self._shards[shard_id][offset:offset + frames]
+        return torch.from_numpy(np.ascontiguousarray(spec.T)).unsqueeze(0)  # (1, n_mels, time)
+
+
+class CachedFeatureDataset(Dataset):
+    """Like AudioDataset, but yields cached mel spectrograms instead of waveforms"""
+    def __init__(self, feature_cache, file_paths, text_list):
+        self.feature_cache = feature_cache
+        self.keys = feature_cache.build(file_paths)
         self.text_list = text_list
 
     def __len__(self):
         return len(self.text_list)
 
     def __getitem__(self, index):
-        audio = self.audio_list[index]
+        spec = self.feature_cache[self.keys[index]]
         text = self.text_list[index]
-        return audio, text
+        return spec, text
+
+"""**Duration-Bucketed Batching**
+
+Utterances are sorted by length and cut into batches, either of `batch_size` items or filling a
+`max_frames` budget (batch size x longest spectrogram). Every epoch, utterances are shuffled only
+within windows of neighbours in the sorted order and the batch order is shuffled, so batches
+stay tight but are not identical from epoch to epoch. Batch sizes are fixed up front, which keeps
+len() stable for OneCycleLR. Utterances only move between batches of the same size: every
+utterance of a batch of k fits in `max_frames / k` frames, so a shuffled batch stays within the budget.
+"""
+
+class BucketBatchSampler(data.Sampler):
+    def __init__(self, durations, batch_size=10, max_frames=None, shuffle=True, shuffle_window=20, seed=7,
+                 num_replicas=1, rank=0):
+        # number of mel frames data_processing will produce for each utterance
+        samples = np.rint(np.asarray(durations) * mel_params['sample_rate']).astype(np.int64)
+        self.frames = samples // mel_params['hop_length'] + 1
+        self.order = np.argsort(self.frames, kind='stable')
+        self.shuffle = shuffle
+        self.shuffle_window = shuffle_window
+        self.seed = seed
+        self.num_replicas = num_replicas  # distributed training: every rank takes every num_replicas-th batch
+        self.rank = rank
+        self.epoch = 0
+        self.start_batch = 0  # batches of the epoch already trained on, skipped when resuming mid-epoch
+        self.padding_ratio = 0.0
+
+        self.batch_sizes = []
+        size, longest = 0, 0
+        for frames in self.frames[self.order]:
+            longest_if_added = max(longest, frames)
+            full = batch_size is not None and size == batch_size
+            over_budget = max_frames is not None and size > 0 and (size + 1) * longest_if_added > max_frames
+            if full or over_budget:
+                self.batch_sizes.append(size)
+                size, longest_if_added = 0, frames
+            size += 1
+            longest = longest_if_added
+        if size:
+            self.batch_sizes.append(size)
+
+        # (start, end) positions in the sorted order of consecutive batches with the same size
+        self.runs = []
+        position = 0
+        for size in self.batch_sizes:
+            if self.runs and self.runs[-1][2] == size:
+                self.runs[-1][1] += size
+            else:
+                self.runs.append([position, position + size, size])
+            position += size
+
+    def set_epoch(self, epoch, start_batch=0):
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def _padding_ratio(self, batches):
+        padded = sum(len(batch) * self.frames[batch].max() for batch in batches)
+        return 1.0 - float(self.frames.sum()) / padded if padded else 0.0
+
+    def __len__(self):
+        return -(-len(self.batch_sizes) // self.num_replicas)
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = self.order.copy()
+        if self.shuffle:
+            for run_start, run_end, _ in self.runs:
+                for start in range(run_start, run_end, self.shuffle_window):
+                    rng.shuffle(order[start:min(start + self.shuffle_window, run_end)])
+        batches = np.split(order, np.cumsum(self.batch_sizes)[:-1])
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        self.padding_ratio = self._padding_ratio(batches)
+        shuffled = np.split(rng.permutation(len(order)), np.cumsum(self.batch_sizes)[:-1])
+        if self.rank == 0:
+            print(f'Bucketed {len(order)} utterances into {len(batches)} batches, padding: {self.padding_ratio:.1%} '
+                  f'of frames (shuffled batches: {self._padding_ratio(shuffled):.1%})')
+
+        if self.num_replicas > 1:
+            # all ranks see the same permutation (same seed); the first batches are repeated so
+            # that every rank runs the same number of steps
+            batches = batches + batches[:len(self) * self.num_replicas - len(batches)]
+            batches = batches[self.rank::self.num_replicas]
+
+        for batch in batches[self.start_batch:]:
+            yield batch.tolist()
 
 """**Deep Learning Model for Speech Recognition Using CNN and Bidirectional GRU**"""
 
@@ -434,15 +1235,176 @@ class SpeechRecognitionModel1(nn.Module):
             nn.Linear(128, num_classes),
         )
         self.softmax = nn.LogSoftmax(dim=1)
-    def forward(self, x):
-        x = self.conv(x)
+    def logits(self, x, lengths=None):
+        """Everything but the final LogSoftmax, which normalizes over time.
+
+        With `lengths` (spectrogram frames of every item of a padded batch) no item sees the padding:
+        the input of every convolution is zeroed past the item's end, as its own zero padding would be,
+        and the GRU runs on packed sequences, so the backward direction starts at the last real frame.
+        """
+        if lengths is None:
+            x = self.conv(x)
+        else:
+            for layer in self.conv:
+                if isinstance(layer, nn.Conv2d):
+                    valid = torch.arange(x.shape[3], device=x.device) < lengths.to(x.device)[:, None]
+                    x = x * valid[:, None, None, :].to(x.dtype)
+                x = layer(x)
+                if isinstance(layer, nn.MaxPool2d):
+                    lengths = lengths // 2
         x = x.permute(0, 3, 1, 2)
         x = x.view(x.size(0), x.size(1), -1)
-        x, _ = self.rnn(x)
+        if lengths is None:
+            x, _ = self.rnn(x)
+        else:
+            packed = nn.utils.rnn.pack_padded_sequence(x, lengths.clamp(min=1).cpu(), batch_first=True,
+                                                       enforce_sorted=False)
+            x, _ = nn.utils.rnn.pad_packed_sequence(self.rnn(packed)[0], batch_first=True, total_length=x.shape[1])
         x = self.fc(x)
+        return x
+    def forward(self, x, lengths=None):
+        x = self.logits(x, lengths)
+        if lengths is not None:
+            # the softmax runs over time, so padded frames are left out of it
+            padding = torch.arange(x.shape[1], device=x.device) >= (lengths.to(x.device) // 4)[:, None]
+            x = self.softmax(x.masked_fill(padding[:, :, None], float('-inf')))
+            return x.masked_fill(padding[:, :, None], 0.0)
         x = self.softmax(x)
         return x
 
+"""**Stage Timing, Metrics Export and Profiling**
+
+`metrics.time(stage)` records the duration of a block in a per-stage latency histogram (ms).
+The same registry is used by `train()` (data loading vs. compute of every step) and by the
+Telegram bot (download, audio decoding, VAD, features, model forward, CTC decoding, reply).
+With METRICS_ENABLED = False, `time()` returns a shared no-op context manager and nothing is
+measured. Histograms are exported as Prometheus text (`metrics.prometheus()`, which the bot
+serves over HTTP when METRICS_PORT is set) and dumped to METRICS_JSON_PATH every
+METRICS_DUMP_SECONDS. PROFILE_STEPS > 0 records a torch.profiler trace of that many training
+steps to PROFILE_DIR (open it in TensorBoard or chrome://tracing).
+"""
+
+import bisect
+import contextlib
+import threading
+
+METRICS_ENABLED = False
+METRICS_JSON_PATH = None  # e.g. "/content/metrics.json", None disables the periodic dump
+METRICS_DUMP_SECONDS = 60
+PROFILE_STEPS = 0  # 0 disables the profiler
+PROFILE_DIR = "/content/profiler"
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+class Histogram:
+    """Histogram with fixed bucket bounds, a value falls into the first bucket >= value"""
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def summary(self):
+        labels = [f"<={b:g}" for b in self.buckets] + [f">{self.buckets[-1]:g}"]
+        mean = self.total / self.count if self.count else 0.0
+        bins = ", ".join(f"{label}: {n}" for label, n in zip(labels, self.counts) if n)
+        return f"n={self.count}, среднее={mean:.1f} ({bins})"
+
+class _StageTimer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, (time.perf_counter() - self.start) * 1000)
+        return False
+
+_NO_TIMER = contextlib.nullcontext()
+
+class StageMetrics:
+    def __init__(self, enabled=METRICS_ENABLED, json_path=METRICS_JSON_PATH, dump_seconds=METRICS_DUMP_SECONDS,
+                 buckets=LATENCY_BUCKETS_MS):
+        self.enabled = enabled
+        self.json_path = json_path
+        self.dump_seconds = dump_seconds
+        self.buckets = buckets
+        self.histograms = {}
+        self._lock = threading.Lock()  # the bot observes from several threads
+        self._last_dump = time.perf_counter()
+
+    def time(self, stage):
+        return _StageTimer(self, stage) if self.enabled else _NO_TIMER
+
+    def observe(self, stage, value_ms):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram(self.buckets)
+            histogram.observe(value_ms)
+            dump_due = self.json_path is not None and now - self._last_dump >= self.dump_seconds
+            if dump_due:
+                self._last_dump = now
+        if dump_due:
+            self.dump_json()
+
+    def to_dict(self):
+        with self._lock:
+            return {stage: {'count': h.count, 'sum_ms': h.total, 'mean_ms': h.total / h.count if h.count else 0.0,
+                            'buckets_ms': dict(zip([f'{b:g}' for b in h.buckets] + ['+Inf'], h.counts))}
+                    for stage, h in self.histograms.items()}
+
+    def summary(self):
+        with self._lock:
+            return '\n'.join(f'{stage}, ms: {h.summary()}' for stage, h in sorted(self.histograms.items()))
+
+    def prometheus(self, name='speech_stage_duration_seconds'):
+        """Prometheus text exposition format, one histogram series per stage"""
+        lines = [f'# HELP {name} Duration of each processing stage.', f'# TYPE {name} histogram']
+        with self._lock:
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip([f'{b / 1000:g}' for b in h.buckets] + ['+Inf'], h.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {h.total / 1000:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump_json(self, path=None):
+        path = path or self.json_path
+        report = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'stages': self.to_dict()}
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(tmp_path, path)
+
+metrics = StageMetrics()
+
+def start_profiler(steps=PROFILE_STEPS, trace_dir=PROFILE_DIR):
+    """Started torch.profiler that records `steps` steps after a warm-up step; call .step() after every batch"""
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    profiler = torch.profiler.profile(activities=activities,
+                                      schedule=torch.profiler.schedule(wait=1, warmup=1, active=steps, repeat=1),
+                                      on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                                      record_shapes=True)
+    profiler.start()
+    return profiler
+
 """nn.Linear(512, 128),<br>
             nn.GELU(),<br>
           nn.Dropout(0.35),
@@ -455,6 +1417,7 @@ import torch.optim as optim
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils import data
+import contextlib
 
 # Assuming you have defined your AudioDataset, SpeechRecognitionModel1, GreedyDecoder, cer, and wer functions
 
@@ -469,43 +1432,88 @@ class IterMeter(object):
     def get(self):
         return self.val
 
-def train(model, device, train_loader, criterion, optimizer, scheduler, epoch, iter_meter):
+def train(model, device, train_loader, criterion, optimizer, scheduler, epoch, iter_meter,
+          scaler=None, checkpoints=None, start_batch=0, checkpoint_every=0,
+          accumulation_steps=1, log_every=10, max_grad_norm=1.0, profiler=None):
+    """One epoch. Gradients of `accumulation_steps` batches are summed before each optimizer step.
+
+    Nothing in the step waits for the GPU. The loss is read back (and inputs are checked for NaN)
+    only every `log_every` batches. With metrics enabled, every step records the time spent waiting
+    for the DataLoader and the time spent computing (the GPU is synchronized for that).
+    """
     model.train()
     data_len = len(train_loader.dataset)
-    scaler = torch.cuda.amp.GradScaler()  # Initialize GradScaler for mixed precision
-
-    for batch_idx, _data in enumerate(train_loader):
+    if scaler is None:
+        scaler = torch.cuda.amp.GradScaler()  # Initialize GradScaler for mixed precision
+    optimizer.zero_grad(set_to_none=True)
+
+    epoch_start = interval_start = time.perf_counter()
+    epoch_steps = epoch_batches = interval_batches = 0
+    num_batches = len(train_loader)
+    fetch_start = time.perf_counter()
+    for batch_idx, _data in enumerate(train_loader, start=start_batch):
+        if metrics.enabled:
+            step_start = time.perf_counter()
+            metrics.observe('train_data_load', (step_start - fetch_start) * 1000)
         spectrograms, labels, input_lengths, label_lengths = _data
-        spectrograms, labels = spectrograms.to(device), labels.to(device)
-
-        optimizer.zero_grad()
-
-        with torch.cuda.amp.autocast():  # Enable mixed precision
-            output = model(spectrograms)  # (batch, time, n_class)
-            output = F.log_softmax(output, dim=2)
-            output = output.transpose(0, 1)  # (time, batch, n_class)
-
-            # Calculate the loss
-            loss = criterion(output, labels, input_lengths, label_lengths)
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-
-        scaler.scale(loss).backward()  # Scale the loss and call backward
-        scaler.step(optimizer)          # Update the optimizer
-        scaler.update()                 # Update the scale for next iteration
-        scheduler.step()
-        iter_meter.step()
+        spectrograms, labels = spectrograms.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+        last_batch = batch_idx + 1 == num_batches
+        optimizer_step = (batch_idx + 1) % accumulation_steps == 0 or last_batch
+        # the last window of the epoch can hold fewer batches, its gradient is their mean too
+        window_start = batch_idx - batch_idx % accumulation_steps
+        window_batches = min(accumulation_steps, num_batches - window_start)
+
+        # DDP all-reduces gradients only on the batch that ends an accumulation window
+        no_sync = getattr(model, 'no_sync', None)
+        with no_sync() if no_sync is not None and not optimizer_step else contextlib.nullcontext():
+            with torch.cuda.amp.autocast(enabled=scaler.is_enabled()):  # Enable mixed precision
+                output = model(spectrograms)  # (batch, time, n_class)
+                output = F.log_softmax(output, dim=2)
+                output = output.transpose(0, 1)  # (time, batch, n_class)
+
+                # Calculate the loss
+                loss = criterion(output, labels, input_lengths, label_lengths)
+
+            scaler.scale(loss / window_batches).backward()  # Scale the loss and call backward
+        interval_batches += 1
+        epoch_batches += 1
+
+        if optimizer_step:
+            scaler.unscale_(optimizer)  # clip the true gradients, not the scaled ones
+            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=max_grad_norm)
+            scaler.step(optimizer)          # Update the optimizer
+            scaler.update()                 # Update the scale for next iteration
+            optimizer.zero_grad(set_to_none=True)
+            scheduler.step()
+            iter_meter.step()
+            epoch_steps += 1
+
+            # Mid-epoch checkpoint, training resumes after this batch
+            if checkpoints is not None and checkpoint_every and iter_meter.get() % checkpoint_every == 0:
+                checkpoints.save(model, optimizer, scheduler, scaler, iter_meter, epoch, batch_idx + 1)
+
+        if batch_idx % log_every == 0 or last_batch:
+            # Debugging: Check for NaN values
+            assert not torch.isnan(spectrograms).any(), "Input contains NaN values"
+            assert not torch.isnan(labels).any(), "Labels contain NaN values"
+
+            elapsed = time.perf_counter() - interval_start
+            print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}\t{:.2f} batches/s'.format(
+                epoch, batch_idx * len(spectrograms), data_len,
+                100. * batch_idx / num_batches, loss.item(), interval_batches / elapsed))
+            interval_start, interval_batches = time.perf_counter(), 0
 
-        # Clear cache to free up memory
-        torch.cuda.empty_cache()
+        if profiler is not None:
+            profiler.step()
+        if metrics.enabled:
+            if spectrograms.is_cuda:
+                torch.cuda.synchronize()
+            fetch_start = time.perf_counter()
+            metrics.observe('train_compute', (fetch_start - step_start) * 1000)
 
-        # Debugging: Check for NaN values
-        assert not torch.isnan(spectrograms).any(), "Input contains NaN values"
-        assert not torch.isnan(labels).any(), "Labels contain NaN values"
-
-        if batch_idx % 10 == 0 or batch_idx == data_len:
-            print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
-                epoch, batch_idx * len(spectrograms), data_len,
-                100. * batch_idx / len(train_loader), loss.item()))
+    elapsed = time.perf_counter() - epoch_start
+    print(f'Epoch {epoch}: {epoch_steps} optimizer steps in {elapsed:.1f}s, '
+          f'{epoch_steps / elapsed:.2f} steps/s, {epoch_batches / elapsed:.2f} batches/s')
 
 def test(model, device, test_loader, criterion, epoch, iter_meter):
     print('\nevaluating...')
@@ -526,16 +1534,17 @@ def test(model, device, test_loader, criterion, epoch, iter_meter):
             test_loss += loss.item() / len(test_loader)
 
             # Assuming you have defined GreedyDecoder, cer, and wer functions
-            decoded_preds, decoded_targets = GreedyDecoder(output.transpose(0, 1), labels, label_lengths)
-            for j in range(len(decoded_preds)):
-                test_cer.append(cer(decoded_targets[j], decoded_preds[j]))
-                test_wer.append(wer(decoded_targets[j], decoded_preds[j]))
+            decoded_preds, decoded_targets = GreedyDecoder(output.transpose(0, 1), labels, label_lengths,
+                                                           output_lengths=input_lengths)
+            test_cer.extend(batch_cer(decoded_targets, decoded_preds))
+            test_wer.extend(batch_wer(decoded_targets, decoded_preds))
 
     avg_cer = sum(test_cer) / len(test_cer) if test_cer else 0
     avg_wer = sum(test_wer) / len(test_wer) if test_wer else 0
 
     print('Test set: Average loss: {:.4f}, Average CER: {:.4f}, Average WER: {:.4f}\n'.format(
         test_loss, avg_cer, avg_wer))
+    return avg_cer, avg_wer
 
 def save_model(model, optimizer, epoch, filename='model_checkpoint.pth'):
     """Save the model checkpoint including optimizer state."""
@@ -553,6 +1562,566 @@ def load_model(model, optimizer, filename='model_checkpoint.pth'):
     optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
     print(f'Model loaded from {filename} (epoch {checkpoint["epoch"]})')
 
+"""**Checkpointing with Resumable Training State**
+
+A checkpoint holds everything needed to continue training exactly where it stopped: model,
+optimizer, scheduler, GradScaler, IterMeter, the Python/NumPy/torch RNG states and the sampler
+position (epoch and number of batches of that epoch already trained on). It keeps the
+`save_model` keys, so `load_model` and the export cell read it as before. It also records the
+digest of the manifest's train/test split; a checkpoint from a different split is not resumed,
+and `best.pth` is only compared against CERs measured on the same test set.
+
+On a mid-epoch resume the sampler skips the batches already trained on. Batches are the same,
+but SpecAugment masks drawn in DataLoader workers are not replayed exactly.
+
+The state dict is copied to CPU on the training thread and written by a background thread,
+so training only waits for the copy. Files are written to a temporary name and renamed, an
+interrupted save never leaves a truncated checkpoint. The last `keep_last` checkpoints are
+kept, plus `best.pth` with the lowest validation CER.
+"""
+
+import copy
+import glob
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+CHECKPOINT_DIR = r"/content/drive/MyDrive/Dataset_PC/RSDA Dataset v5/checkpoints"
+
+def _to_cpu(obj):
+    """Deep copy of a (nested) state dict with every tensor moved to CPU"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return copy.deepcopy(obj)
+
+def _numpy_rng_state():
+    """np.random state with the key array as a tensor, so torch.load(weights_only=True) accepts it"""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian
+
+class CheckpointManager:
+    def __init__(self, checkpoint_dir=CHECKPOINT_DIR, keep_last=3, split=None):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.split = split  # split_digest of the manifest being trained on
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.best_path = os.path.join(checkpoint_dir, 'best.pth')
+        self.best_info_path = os.path.join(checkpoint_dir, 'best.json')
+        self.best_cer = float('inf')
+        if os.path.exists(self.best_info_path):
+            with open(self.best_info_path) as f:
+                best_info = json.load(f)
+            if best_info.get('split') == split:
+                self.best_cer = best_info['cer']
+            else:
+                print(f"{self.best_path} was evaluated on a different test set, it will be replaced by the next "
+                      f"evaluated checkpoint")
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def checkpoints(self):
+        """Checkpoint paths from oldest to newest"""
+        return sorted(glob.glob(os.path.join(self.checkpoint_dir, 'checkpoint_e*_b*.pth')))
+
+    def latest(self):
+        paths = self.checkpoints()
+        return paths[-1] if paths else None
+
+    def save(self, model, optimizer, scheduler, scaler, iter_meter, epoch, batches_done, cer=None):
+        """Schedules a save of the state after `batches_done` batches of `epoch`, returns immediately"""
+        model = getattr(model, 'module', model)  # DistributedDataParallel wrapper
+        state = _to_cpu({
+            'epoch': epoch,
+            'batches_done': batches_done,
+            'iteration': iter_meter.get(),
+            'model_state_dict': model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'scheduler_state_dict': scheduler.state_dict(),
+            'scaler_state_dict': scaler.state_dict(),
+            'rng_state': {
+                'python': random.getstate(),
+                'numpy': _numpy_rng_state(),
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            },
+            'cer': cer,
+            'split': self.split,
+        })
+        self.wait()  # one save in flight, its CPU copy is the only extra memory
+        self._pending = self._executor.submit(self._write, state)
+
+    def wait(self):
+        """Blocks until the pending save is on disk, re-raises its error"""
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def _atomic_save(self, state, path):
+        tmp_path = path + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _write(self, state):
+        start = time.perf_counter()
+        path = os.path.join(self.checkpoint_dir,
+                            f"checkpoint_e{state['epoch']:04d}_b{state['batches_done']:06d}.pth")
+        self._atomic_save(state, path)
+        for old_path in self.checkpoints()[:-self.keep_last]:
+            os.remove(old_path)
+
+        cer = state['cer']
+        if cer is not None and cer < self.best_cer:
+            self._atomic_save(state, self.best_path)
+            with open(self.best_info_path + '.tmp', 'w') as f:
+                json.dump({'cer': cer, 'epoch': state['epoch'], 'iteration': state['iteration'],
+                           'split': state['split']}, f)
+            os.replace(self.best_info_path + '.tmp', self.best_info_path)
+            self.best_cer = cer
+        print(f'Checkpoint saved to {path} in {time.perf_counter() - start:.1f}s'
+              + (f' (best CER {self.best_cer:.4f})' if cer is not None else ''))
+
+    def load(self, path, model, optimizer, scheduler, scaler, iter_meter):
+        """Restores the training state, returns (epoch, batches_done) to resume from"""
+        state = torch.load(path, map_location='cpu')
+        if state.get('split') != self.split:
+            raise ValueError(f"{path} was trained on train/test split {state.get('split')}, the manifest has "
+                             f"{self.split}; restore the manifest it was trained on or use a new CHECKPOINT_DIR")
+        model.load_state_dict(state['model_state_dict'])
+        optimizer.load_state_dict(state['optimizer_state_dict'])
+        scheduler.load_state_dict(state['scheduler_state_dict'])
+        scaler.load_state_dict(state['scaler_state_dict'])
+        iter_meter.val = state['iteration']
+
+        rng_state = state['rng_state']
+        random.setstate(rng_state['python'])
+        name, keys, pos, has_gauss, cached_gaussian = rng_state['numpy']
+        np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+        torch.set_rng_state(rng_state['torch'])
+        if rng_state['cuda'] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng_state['cuda'])
+        print(f"Resuming from {path}: epoch {state['epoch']}, {state['batches_done']} batches done, "
+              f"iteration {state['iteration']}")
+        return state['epoch'], state['batches_done']
+
+"""**Chunked Recognition of Long Recordings**
+
+The BiGRU needs the whole sequence, so memory grows with the recording. Long audio is split into
+overlapping windows aligned to model output frames (4 mel frames = 800 samples). Each window goes
+through the CNN+BiGRU separately, and the logits are stitched by keeping each window's centre.
+The model's final LogSoftmax runs over time, so it is applied once to the stitched logits.
+Only one window's activations are alive at a time.
+"""
+
+CHUNK_SECONDS = 20  # window length
+CHUNK_OVERLAP_SECONDS = 2  # context shared by neighbouring windows, half of it is dropped on each side
+
+def full_log_probs(model, samples):
+    """(time, n_class) log-probs for a whole 16 kHz recording in one pass"""
+    with torch.no_grad():
+        spectrogram = valid_audio_transforms(torch.from_numpy(samples).unsqueeze(0)).unsqueeze(0)
+        return F.log_softmax(model(spectrogram), dim=2)[0]
+
+def chunked_log_probs(model, samples, chunk_seconds=CHUNK_SECONDS, overlap_seconds=CHUNK_OVERLAP_SECONDS):
+    """(time, n_class) log-probs for a 16 kHz recording, computed window by window"""
+    frame_samples = mel_params['hop_length'] * 4  # samples per model output frame
+    chunk = max(2, round(chunk_seconds * mel_params['sample_rate'] / frame_samples))
+    overlap = min(chunk - 1, round(overlap_seconds * mel_params['sample_rate'] / frame_samples))
+    half = overlap // 2
+    step = chunk - overlap
+
+    pieces = []
+    start = 0  # in output frames
+    with torch.no_grad():
+        while True:
+            end_sample = min(len(samples), (start + chunk) * frame_samples)
+            waveform = torch.from_numpy(samples[start * frame_samples:end_sample]).unsqueeze(0)
+            logits = model.logits(valid_audio_transforms(waveform).unsqueeze(0))[0]
+            last = end_sample >= len(samples)
+            keep_from = 0 if start == 0 else half
+            keep_to = logits.shape[0] if last else chunk - (overlap - half)
+            pieces.append(logits[keep_from:keep_to])
+            if last:
+                break
+            start += step
+        return F.log_softmax(model.softmax(torch.cat(pieces).unsqueeze(0)), dim=2)[0]
+
+def check_chunked_recognition(model, recordings, chunk_seconds=CHUNK_SECONDS,
+                              overlap_seconds=CHUNK_OVERLAP_SECONDS, tolerance=0.05):
+    """Checks that chunked decoding stays within `tolerance` CER of full-utterance decoding.
+
+    `run_benchmarks` runs it on a fixed-seed model and synthetic recordings longer than one window;
+    run it on a trained model and long test recordings (e.g. concatenated utterances) as well.
+    """
+    model.eval()
+    full, chunked = [], []
+    for samples in recordings:
+        full.append(decode_predictions(full_log_probs(model, samples).unsqueeze(0))[0])
+        chunked.append(decode_predictions(
+            chunked_log_probs(model, samples, chunk_seconds, overlap_seconds).unsqueeze(0))[0])
+    edit_distances, ref_lens = batch_char_errors(full, chunked)
+    score = sum(edit_distances) / max(1, sum(ref_lens))
+    print(f'CER of chunked vs full-utterance decoding: {score:.4f} (tolerance {tolerance})')
+    assert score <= tolerance, 'chunked decoding differs too much from full-utterance decoding'
+    return score
+
+"""**Batched Recognition Independent of Padding**
+
+When recordings of different lengths share a forward pass (the bot's BatchingScheduler, offline
+evaluation), each one must get the log-probs it would get on its own. SpeechRecognitionModel1 is
+given the lengths and ignores the padding; a traced (quantized) model only takes the padded
+input, so only spectrograms of equal length share a pass. `check_batched_recognition` verifies it.
+"""
+
+from collections import defaultdict
+
+def batch_log_probs(model, spectrograms):
+    """(time, n_class) log-probs of every (time, n_mels) spectrogram, computed in as few passes as possible"""
+    takes_lengths = isinstance(model, SpeechRecognitionModel1)
+    if takes_lengths:
+        groups = [list(range(len(spectrograms)))]
+    else:
+        by_length = defaultdict(list)
+        for i, spec in enumerate(spectrograms):
+            by_length[spec.shape[0]].append(i)
+        groups = list(by_length.values())
+
+    outputs = [None] * len(spectrograms)
+    with torch.no_grad():
+        for group in groups:
+            inputs = pad_spectrograms([spectrograms[i] for i in group])
+            if takes_lengths:
+                output = model(inputs, torch.tensor([spectrograms[i].shape[0] for i in group]))
+            else:
+                output = model(inputs)
+            output = F.log_softmax(output, dim=2)
+            for j, i in enumerate(group):
+                outputs[i] = output[j, :spectrograms[i].shape[0] // 4]
+    return outputs
+
+def check_batched_recognition(model, recordings, atol=1e-4):
+    """Checks that each 16 kHz recording gets the same log-probs in a padded batch as alone"""
+    model.eval()
+    spectrograms = [valid_audio_transforms(torch.from_numpy(samples).unsqueeze(0)).squeeze(0).transpose(0, 1)
+                    for samples in recordings]
+    batched = batch_log_probs(model, spectrograms)
+    difference = max(float((log_probs - full_log_probs(model, samples)).abs().max())
+                     for log_probs, samples in zip(batched, recordings))
+    print(f'Max difference of batched vs single-recording log-probs: {difference:.2e} (tolerance {atol})')
+    assert difference <= atol, 'batched recognition depends on the other recordings of the batch'
+    return difference
+
+"""**CTC Prefix Beam Search with a Character N-gram LM**
+
+Beam search over the model's log-probs, considering only the top-k labels of every frame.
+It can optionally be shallow-fused with a character n-gram LM trained on the `text` column of
+Data.xlsx. The LM uses stupid backoff. For every n-gram length it stores a sorted int64 array of
+encoded n-grams and a float32 array of log-probs, saved as a single .npz file to CHAR_LM_PATH,
+where the bot loads it from. The LM is built only when that file is missing or LM_REBUILD is set.
+"""
+
+import math
+from collections import Counter, defaultdict
+
+CHAR_LM_PATH = r"/content/drive/MyDrive/Dataset_PC/RSDA Dataset v5/char_lm.npz"
+LM_REBUILD = False  # set to rebuild the LM after Data.xlsx changed
+
+class CharNgramLM:
+    def __init__(self, order, n_class, unigram, keys, log_probs, backoff=0.4):
+        self.order = order
+        self.n_class = n_class
+        self.bos = n_class  # sentence start, also the base of the n-gram encoding is n_class + 1
+        self.unigram = unigram
+        self.keys = keys  # {n: sorted encoded n-grams}
+        self.log_probs = log_probs  # {n: log P(last label | first n - 1 labels)}
+        self.backoff = backoff
+        self.log_backoff = math.log(backoff)
+        self._scores = {}
+
+    def _encode(self, ngram):
+        key = 0
+        for label in ngram:
+            key = key * (self.n_class + 1) + label
+        return key
+
+    @classmethod
+    def build(cls, texts, order=4, n_class=34, backoff=0.4):
+        lm = cls(order, n_class, None, {}, {}, backoff)
+        counts = {n: Counter() for n in range(1, order + 1)}
+        encoded, lengths = text_transform.encode_batch(texts)
+        for labels, length in zip(encoded.tolist(), lengths):
+            labels = [lm.bos] * (order - 1) + labels[:length]
+            for i in range(order - 1, len(labels)):
+                for n in range(1, order + 1):
+                    counts[n][lm._encode(labels[i - n + 1:i + 1])] += 1
+
+        unigram = np.ones(n_class, dtype=np.float64)  # add-one smoothing
+        for key, count in counts[1].items():
+            unigram[key] += count
+        lm.unigram = np.log(unigram / unigram.sum()).astype(np.float32)
+
+        for n in range(2, order + 1):
+            context_counts = Counter()
+            for key, count in counts[n].items():
+                context_counts[key // (n_class + 1)] += count
+            keys = np.array(sorted(counts[n]), dtype=np.int64)
+            lm.keys[n] = keys
+            lm.log_probs[n] = np.array([math.log(counts[n][k] / context_counts[k // (n_class + 1)]) for k in keys.tolist()],
+                                       dtype=np.float32)
+        return lm
+
+    def save(self, path):
+        arrays = {'order': self.order, 'n_class': self.n_class, 'backoff': self.backoff, 'unigram': self.unigram}
+        for n in self.keys:
+            arrays[f'keys_{n}'] = self.keys[n]
+            arrays[f'log_probs_{n}'] = self.log_probs[n]
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        order = int(arrays['order'])
+        return cls(order, int(arrays['n_class']), arrays['unigram'],
+                   {n: arrays[f'keys_{n}'] for n in range(2, order + 1)},
+                   {n: arrays[f'log_probs_{n}'] for n in range(2, order + 1)},
+                   float(arrays['backoff']))
+
+    def score(self, context, label):
+        """log P(label | context), context holds the last order - 1 labels (padded with bos)"""
+        cached = self._scores.get((context, label))
+        if cached is not None:
+            return cached
+        score = 0.0
+        for n in range(self.order, 1, -1):
+            key = self._encode(context[len(context) - n + 1:] + (label,))
+            keys = self.keys[n]
+            i = np.searchsorted(keys, key)
+            if i < len(keys) and keys[i] == key:
+                score += float(self.log_probs[n][i])
+                break
+            score += self.log_backoff
+        else:
+            score += float(self.unigram[label])
+        self._scores[(context, label)] = score
+        return score
+
+
+def _log_add(a, b):
+    if a == -math.inf:
+        return b
+    if b == -math.inf:
+        return a
+    return max(a, b) + math.log1p(math.exp(-abs(a - b)))
+
+
+def ctc_prefix_beam_search(log_probs, beam_width=8, top_k=8, lm=None, lm_weight=0.5, insertion_bonus=0.0,
+                           blank_label=28):
+    """Decodes (time, n_class) log-probs of one utterance, returns the best transcript"""
+    log_probs = log_probs.detach().cpu().numpy()
+    top_k = min(top_k, log_probs.shape[1])
+    context_len = lm.order - 1 if lm is not None else 0
+
+    # prefix -> (log P ending in blank, log P ending in a label); prefix -> LM score + insertion bonus
+    beams = {(): (0.0, -math.inf)}
+    prefix_scores = {(): 0.0}
+    for frame in log_probs:
+        labels = np.argpartition(frame, -top_k)[-top_k:].tolist()
+        frame = frame.tolist()
+        next_beams = defaultdict(lambda: [-math.inf, -math.inf])
+        for prefix, (p_blank, p_label) in beams.items():
+            p_total = _log_add(p_blank, p_label)
+            for label in labels:
+                p = frame[label]
+                if label == blank_label:
+                    beam = next_beams[prefix]
+                    beam[0] = _log_add(beam[0], p_total + p)
+                    continue
+
+                new_prefix = prefix + (label,)
+                if new_prefix not in prefix_scores:
+                    score = prefix_scores[prefix] + insertion_bonus
+                    if lm is not None:
+                        context = ((lm.bos,) * context_len + prefix)[len(prefix):]
+                        score += lm_weight * lm.score(context, label)
+                    prefix_scores[new_prefix] = score
+
+                beam = next_beams[new_prefix]
+                if prefix and label == prefix[-1]:
+                    # a repeat only starts a new label after a blank, otherwise it collapses
+                    beam[1] = _log_add(beam[1], p_blank + p)
+                    same = next_beams[prefix]
+                    same[1] = _log_add(same[1], p_label + p)
+                else:
+                    beam[1] = _log_add(beam[1], p_total + p)
+
+        ranked = sorted(next_beams.items(), key=lambda item: _log_add(*item[1]) + prefix_scores[item[0]], reverse=True)
+        beams = {prefix: tuple(probs) for prefix, probs in ranked[:beam_width]}
+        prefix_scores = {prefix: prefix_scores[prefix] for prefix in beams}
+
+    best = max(beams, key=lambda prefix: _log_add(*beams[prefix]) + prefix_scores[prefix])
+    return text_transform.int_to_text(list(best))
+
+
+def benchmark_beam_search(model, recordings, beam_widths=(1, 4, 8, 16), lm=None):
+    """Prints decoding time in ms per second of audio for each beam width (model forward excluded)"""
+    model.eval()
+    log_probs = [full_log_probs(model, samples) for samples in recordings]
+    audio_seconds = sum(len(samples) for samples in recordings) / mel_params['sample_rate']
+    results = {}
+    for beam_width in beam_widths:
+        start = time.perf_counter()
+        for utterance in log_probs:
+            ctc_prefix_beam_search(utterance, beam_width, lm=lm)
+        results[beam_width] = (time.perf_counter() - start) * 1000 / audio_seconds
+        print(f'beam width {beam_width:3d}{" + LM" if lm is not None else ""}: '
+              f'{results[beam_width]:.2f} ms per audio-second')
+    return results
+
+if dist_rank == 0 and (LM_REBUILD or not os.path.exists(CHAR_LM_PATH)):
+    char_lm = CharNgramLM.build(list(file['text']))
+    char_lm.save(CHAR_LM_PATH)
+    print(f'Character {char_lm.order}-gram LM saved to {CHAR_LM_PATH}')
+
+"""**Post-Training Quantization and Export for CPU Serving**
+
+Loads a checkpoint with a `model_state_dict` (`best.pth` in CHECKPOINT_DIR, written by training,
+or a `save_model` file), folds every BatchNorm2d into the Conv2d before it, applies dynamic int8
+quantization to the GRU and Linear layers and saves the result as TorchScript (`forward` and
+`logits` are traced). ONNX has no export for dynamically quantized GRUs, so TorchScript is the
+fast-loading format. The BatchNorm-folded fp32 model is traced and saved next to it (`_fp32.pt`),
+so size and load time are compared between two TorchScript files. The accuracy/speed trade-off
+against the fp32 model is measured on a held-out manifest and saved as JSON next to the artifact.
+"""
+
+import copy
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+def fold_batchnorm(model):
+    """Copy of SpeechRecognitionModel1 with BatchNorm2d folded into the preceding Conv2d"""
+    model = copy.deepcopy(model).eval()
+    layers = list(model.conv)
+    for i in range(1, len(layers)):
+        if isinstance(layers[i], nn.BatchNorm2d) and isinstance(layers[i - 1], nn.Conv2d):
+            layers[i - 1] = fuse_conv_bn_eval(layers[i - 1], layers[i])
+            layers[i] = nn.Identity()
+    model.conv = nn.Sequential(*layers)
+    return model
+
+def quantize_model(model):
+    return torch.ao.quantization.quantize_dynamic(fold_batchnorm(model), {nn.GRU, nn.Linear}, dtype=torch.qint8)
+
+def evaluate_on_cpu(model, loader):
+    """Greedy CER/WER and forward latency (ms per utterance) on a valid-mode DataLoader"""
+    cers, wers, latencies = [], [], []
+    with torch.no_grad():
+        for spectrograms, labels, input_lengths, label_lengths in loader:
+            start = time.perf_counter()
+            output = F.log_softmax(model(spectrograms), dim=2)
+            latencies.append((time.perf_counter() - start) * 1000 / len(spectrograms))
+            decoded_preds, decoded_targets = GreedyDecoder(output, labels, label_lengths,
+                                                           output_lengths=input_lengths)
+            cers.extend(batch_cer(decoded_targets, decoded_preds))
+            wers.extend(batch_wer(decoded_targets, decoded_preds))
+    return {
+        'cer': sum(cers) / len(cers) if cers else 0,
+        'wer': sum(wers) / len(wers) if wers else 0,
+        'latency_ms': float(np.mean(latencies)) if latencies else 0,
+    }
+
+def export_quantized_model(checkpoint_path, output_path, eval_manifest, n_class=34):
+    model = SpeechRecognitionModel1(n_class)
+    model.load_state_dict(torch.load(checkpoint_path, map_location='cpu')['model_state_dict'])
+    model.eval()
+
+    eval_loader = data.DataLoader(dataset=AudioDataset(eval_manifest),
+                                  batch_size=1,
+                                  shuffle=False,
+                                  collate_fn=lambda x: data_processing(x, 'valid'))
+    example = next(iter(eval_loader))[0]
+    fp32_path = os.path.splitext(output_path)[0] + '_fp32.pt'
+    artifacts = {'fp32': (fold_batchnorm(model), fp32_path), 'int8': (quantize_model(model), output_path)}
+
+    report = {}
+    for name, (artifact, path) in artifacts.items():
+        torch.jit.save(torch.jit.trace_module(artifact, {'forward': example, 'logits': example}), path)
+        start = time.perf_counter()
+        loaded = torch.jit.load(path)
+        load_seconds = time.perf_counter() - start
+        report[name] = dict(evaluate_on_cpu(loaded, eval_loader), size_mb=os.path.getsize(path) / 2**20,
+                            load_seconds=load_seconds)
+    with open(os.path.splitext(output_path)[0] + '_report.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    for name, row in report.items():
+        print(f"{name}: size {row['size_mb']:.1f} MB, load {row['load_seconds'] * 1000:.0f} ms, "
+              f"latency {row['latency_ms']:.1f} ms/utterance, CER {row['cer']:.4f}, WER {row['wer']:.4f}")
+    return report
+
+"""**Data-Parallel Training on CPU Cores (DDP over gloo)**
+
+Launched with `torchrun --standalone --nproc_per_node=N "Speech recognition.py"`, `main()` runs one
+process per rank with the gloo backend. Every rank takes its share of the bucketed batches
+(`BucketBatchSampler` is sharded rather than replaced by `DistributedSampler`, so the length
+bucketing is kept), gradients are averaged by `DistributedDataParallel`, and only rank 0 evaluates
+and writes checkpoints. Without torchrun the script trains in a single process as before.
+The process group is joined in the Distributed launch cell, and the data (manifest with its
+seeded train/test split, feature cache) is prepared by rank 0 so that all ranks read the same files.
+`ddp_scaling_report` measures samples/sec for several process counts on synthetic batches.
+"""
+
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+def _ddp_throughput_worker(rank, world_size, port, batch_size, seconds, steps, results):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank),
+                      WORLD_SIZE=str(world_size), LOCAL_WORLD_SIZE=str(world_size))
+    setup_distributed()
+    torch.manual_seed(rank)
+    spectrograms, labels, input_lengths, label_lengths = data_processing(
+        [(torch.randn(1, seconds * mel_params['sample_rate']), 'привет как дела') for _ in range(batch_size)], 'train')
+    model = SpeechRecognitionModel1(34)
+    if world_size > 1:
+        model = DistributedDataParallel(model)
+    optimizer = optim.AdamW(model.parameters(), 5e-4)
+    criterion = nn.CTCLoss(blank=28)
+
+    def step():
+        optimizer.zero_grad(set_to_none=True)
+        output = F.log_softmax(model(spectrograms), dim=2).transpose(0, 1)
+        criterion(output, labels, input_lengths, label_lengths).backward()
+        optimizer.step()
+
+    step()  # warm-up
+    if world_size > 1:
+        dist.barrier()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        results.put(world_size * batch_size * steps / elapsed)
+    if world_size > 1:
+        dist.destroy_process_group()
+
+def ddp_scaling_report(output_path, process_counts=(1, 2, 4), batch_size=8, seconds=5, steps=10, port=29511):
+    """Training samples/sec for each process count, every rank runs batches of `batch_size` utterances"""
+    report = {'cpu_count': os.cpu_count(), 'batch_size_per_rank': batch_size, 'seconds': seconds, 'runs': []}
+    for n in process_counts:
+        results = mp.get_context('fork').SimpleQueue()
+        mp.start_processes(_ddp_throughput_worker, args=(n, port + n, batch_size, seconds, steps, results),
+                           nprocs=n, start_method='fork')
+        samples_per_sec = results.get()
+        baseline = report['runs'][0] if report['runs'] else {'processes': n, 'samples_per_sec': samples_per_sec}
+        speedup = samples_per_sec / baseline['samples_per_sec']
+        report['runs'].append({'processes': n, 'samples_per_sec': samples_per_sec, 'speedup': speedup,
+                               'efficiency': speedup * baseline['processes'] / n})
+        print(f'{n} processes: {samples_per_sec:.1f} samples/sec, speedup {speedup:.2f}x, '
+              f"efficiency {report['runs'][-1]['efficiency']:.0%}")
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
 def main(learning_rate=5e-4, batch_size=10, epochs=10):
     hparams = {
         "n_cnn_layers": 2,
@@ -564,48 +2133,102 @@ def main(learning_rate=5e-4, batch_size=10, epochs=10):
         "dropout": 0.1,
         "learning_rate": learning_rate,
         "batch_size": batch_size,
-        "epochs": epochs
+        "max_frames": None,  # frames per batch budget, used instead of batch_size when set
+        "epochs": epochs,
+        "num_workers": 2,
+        "accumulation_steps": 1,  # batches per optimizer step, effective batch = batch_size * accumulation_steps
+        "log_every": 10,  # batches between loss prints and NaN checks
+        "keep_checkpoints": 3,
+        "checkpoint_every": 500  # optimizer steps between mid-epoch checkpoints, 0 saves only at the end of an epoch
     }
 
-    use_cuda = torch.cuda.is_available()
+    rank, world_size = setup_distributed()
+    use_cuda = torch.cuda.is_available() and world_size == 1  # the distributed mode is CPU-only (gloo)
     torch.manual_seed(7)
     device = torch.device("cuda" if use_cuda else "cpu")
 
-    # Assuming X_train, y_train, X_test, y_test are defined
-    train_dataset = AudioDataset(X_train, y_train)
-    test_dataset = AudioDataset(X_test, y_test)
-
-    kwargs = {'num_workers': 1, 'pin_memory': True} if use_cuda else {}
+    # Assuming train_manifest and test_manifest are defined
+    precomputed = FEATURE_CACHE_DIR is not None
+    if precomputed:
+        # rank 0 computes the missing features, the other ranks then only read the index
+        with rank_zero_first():
+            feature_cache = FeatureCache(FEATURE_CACHE_DIR, vad_params=vad_params if VAD_ENABLED else None)
+            train_dataset = CachedFeatureDataset(feature_cache, list(train_manifest['path']),
+                                                 list(train_manifest['text']))
+            test_dataset = CachedFeatureDataset(feature_cache, list(test_manifest['path']),
+                                                list(test_manifest['text']))
+    else:
+        train_dataset = AudioDataset(train_manifest)
+        test_dataset = AudioDataset(test_manifest)
+
+    # audio is decoded in the workers, so use them on CPU too
+    kwargs = {'num_workers': hparams['num_workers'], 'pin_memory': use_cuda}
+    batch_size = None if hparams['max_frames'] else hparams['batch_size']
+    # bucketed on the length after silence removal, which is what the datasets yield
+    train_sampler = BucketBatchSampler(list(train_manifest['speech_duration']), batch_size, hparams['max_frames'],
+                                       num_replicas=world_size, rank=rank)
+    test_sampler = BucketBatchSampler(list(test_manifest['speech_duration']), batch_size, hparams['max_frames'],
+                                      shuffle=False)
+    # worker seeds come from their own generator, reseeded every epoch, so starting the
+    # loader does not advance the global RNG that checkpoints restore
+    loader_generator = torch.Generator()
     train_loader = data.DataLoader(dataset=train_dataset,
-                                   batch_size=hparams['batch_size'],
-                                   shuffle=True,
-                                   collate_fn=lambda x: data_processing(x, 'train'),
+                                   batch_sampler=train_sampler,
+                                   collate_fn=lambda x: data_processing(x, 'train', precomputed),
+                                   generator=loader_generator,
                                    **kwargs)
     test_loader = data.DataLoader(dataset=test_dataset,
-                                  batch_size=hparams['batch_size'],
-                                  shuffle=False,
-                                  collate_fn=lambda x: data_processing(x, 'valid'),
+                                  batch_sampler=test_sampler,
+                                  collate_fn=lambda x: data_processing(x, 'valid', precomputed),
                                   **kwargs)
 
     model = SpeechRecognitionModel1(hparams['n_class']).to(device)
+    train_model = DistributedDataParallel(model) if world_size > 1 else model
 
-    print(model)
-    print('Num Model Parameters', sum([param.nelement() for param in model.parameters()]))
+    if rank == 0:
+        print(model)
+        print('Num Model Parameters', sum([param.nelement() for param in model.parameters()]))
 
     optimizer = optim.AdamW(model.parameters(), hparams['learning_rate'])
     criterion = nn.CTCLoss(blank=28).to(device)
     scheduler = optim.lr_scheduler.OneCycleLR(optimizer, max_lr=hparams['learning_rate'],
-                                               steps_per_epoch=int(len(train_loader)),
+                                               steps_per_epoch=-(-len(train_loader) // hparams['accumulation_steps']),
                                                epochs=hparams['epochs'],
                                                anneal_strategy='linear')
 
     iter_meter = IterMeter()
-    for epoch in range(1, epochs + 1):
-        train(model, device, train_loader, criterion, optimizer, scheduler, epoch, iter_meter)
-        test(model, device, test_loader, criterion, epoch, iter_meter)
-
-        # Save the model after each epoch
-        save_model(model, optimizer, epoch)
+    scaler = torch.cuda.amp.GradScaler()
+    checkpoints = CheckpointManager(CHECKPOINT_DIR, hparams['keep_checkpoints'], split=manifest_split)
+    start_epoch, start_batch = 1, 0
+    if checkpoints.latest() is not None:
+        start_epoch, start_batch = checkpoints.load(checkpoints.latest(), model, optimizer, scheduler, scaler,
+                                                    iter_meter)
+        if start_batch >= len(train_loader):
+            start_epoch, start_batch = start_epoch + 1, 0
+
+    profiler = start_profiler() if PROFILE_STEPS and rank == 0 else None
+    for epoch in range(start_epoch, epochs + 1):
+        train_sampler.set_epoch(epoch, start_batch)
+        loader_generator.manual_seed(7 + epoch + 1000 * rank)
+        train(train_model, device, train_loader, criterion, optimizer, scheduler, epoch, iter_meter,
+              scaler, checkpoints if rank == 0 else None, start_batch, hparams['checkpoint_every'],
+              hparams['accumulation_steps'], hparams['log_every'], profiler=profiler)
+        start_batch = 0
+
+        if rank == 0:
+            avg_cer, avg_wer = test(model, device, test_loader, criterion, epoch, iter_meter)
+
+            # Save the full training state after each epoch
+            checkpoints.save(model, optimizer, scheduler, scaler, iter_meter, epoch, len(train_loader), cer=avg_cer)
+        if world_size > 1:
+            dist.barrier()  # the other ranks wait for evaluation
+    checkpoints.wait()
+    if profiler is not None:
+        profiler.stop()
+    if metrics.enabled and metrics.json_path is not None:
+        metrics.dump_json()
+    if world_size > 1:
+        dist.destroy_process_group()
 
 if __name__ == '__main__':
     learning_rate = 0.0001
@@ -627,9 +2250,22 @@ import librosa
 import nest_asyncio
 import pandas as pd
 import requests
+import soundfile as sf
+import asyncio
+import hashlib
+import io
+import json
+import pickle
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+import threading
+import torch
+import torch.nn.functional as F
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext
-from fuzzywuzzy import fuzz  # Импортируем fuzzywuzzy для расстояния Левенштейна
 import os
 
 # Применяем nest_asyncio для разрешения вложенных событийных циклов
@@ -637,96 +2273,522 @@ nest_asyncio.apply()
 
 # Конфигурация
 EXCEL_FILE_PATH = "/content/Adjusted_Data.xlsx"  # Измените это на ваш статический путь к файлу
+TRANSCRIPTS_CACHE_PATH = "/content/Adjusted_Data.pkl"  # Бинарная копия эталонных текстов для быстрого запуска
 TOKEN = "tok"  # Замените на ваш фактический токен
-API_URL = "https://api-inference.huggingface.co/models/jonatasgrosman/wav2vec2-large-xlsr-53-russian"
+API_URL = os.environ.get("ASR_API_URL", "https://api-inference.huggingface.co/models/jonatasgrosman/wav2vec2-large-xlsr-53-russian")  # Можно указать локальную заглушку
 headers = {"Authorization": ""}  # Замените на ваш фактический токен
 
-# Загружаем Excel файл в память и преобразуем 'id' в строку
-df = pd.read_excel(EXCEL_FILE_PATH)
-df['id'] = df['id'].astype(str)  # Убедитесь, что 'id' является строкой для сравнения
+# Бэкенд распознавания: "remote" (Hugging Face API), "local_model" (наш SpeechRecognitionModel1)
+# или "local_wav2vec2" (локально сохраненная модель wav2vec2)
+RECOGNIZER_BACKEND = os.environ.get("RECOGNIZER_BACKEND", "remote")
+MODEL_CHECKPOINT_PATH = os.path.join(CHECKPOINT_DIR, "best.pth")  # Лучший по CER чекпоинт обучения (или файл save_model)
+QUANTIZED_MODEL_PATH = None  # Артефакт export_quantized_model (int8 TorchScript); если задан, используется вместо чекпоинта
+WAV2VEC2_MODEL_PATH = "/content/wav2vec2-large-xlsr-53-russian"  # Локальная копия модели с Hugging Face
+
+# Декодирование для бэкенда "local_model": "greedy" или "beam" (CTC beam search)
+DECODER = "greedy"
+BEAM_WIDTH = 8
+USE_CHAR_LM = True  # Символьная n-граммная модель из CHAR_LM_PATH (ячейка CTC Prefix Beam Search); False — без нее
+LM_WEIGHT = 0.5
+LM_INSERTION_BONUS = 1.0
+
+# Параллельная обработка запросов
+RECOGNITION_WORKERS = 4  # Размер пула потоков для распознавания
+MAX_IN_FLIGHT = 32  # Сколько аудио может обрабатываться и ждать в очереди одновременно
+REQUEST_TIMEOUT = 60  # Секунд на распознавание одного аудио
+
+# Объединение одновременных запросов в батчи (для бэкенда "local_model")
+BATCHING_ENABLED = True
+MAX_BATCH_SIZE = 8  # Максимум аудио в одном проходе модели
+MAX_BATCH_WAIT_MS = 50  # Сколько ждать остальные запросы после первого
+
+# Метрики по этапам обработки (включаются METRICS_ENABLED в ячейке Stage Timing)
+METRICS_PORT = None  # Например 9100: Prometheus забирает метрики с http://<хост>:9100/metrics
+
+# Кэш результатов распознавания для повторно присланных записей
+RESULT_CACHE_SIZE = 1024  # Сколько результатов хранить в памяти
+RESULT_CACHE_DIR = "/content/transcription_cache"  # None — хранить только в памяти
+RESULT_CACHE_DISK_ITEMS = 20000  # Сколько результатов хранить на диске, давно не запрошенные удаляются
+
+# Эталонные тексты: словарь id -> текст, сохраненный в pickle.
+# Excel читается только если файл изменился с момента построения кэша.
+class TranscriptStore:
+    def __init__(self, excel_path=EXCEL_FILE_PATH, cache_path=TRANSCRIPTS_CACHE_PATH):
+        source_mtime = os.path.getmtime(excel_path)
+        self.index = None
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                cached = pickle.load(f)
+            if cached["source_mtime"] == source_mtime:
+                self.index = cached["index"]
+
+        if self.index is None:
+            df = pd.read_excel(excel_path)
+            df['id'] = df['id'].astype(str)  # Убедитесь, что 'id' является строкой для сравнения
+            df = df.drop_duplicates('id')  # Как и раньше, берем первую строку с таким id
+            self.index = dict(zip(df['id'], df['text']))
+            tmp_path = cache_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump({"source_mtime": source_mtime, "index": self.index}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+            print(f"Кэш эталонных текстов пересобран: {cache_path}")
 
-# Утилитарные функции
-def calculate_accuracy(predicted_text, actual_text):
-    predicted_words = predicted_text.split()
-    actual_words = actual_text.split()
+    def __len__(self):
+        return len(self.index)
 
-    # Подсчитываем правильные совпадения
-    correct_words = sum(1 for p, a in zip(predicted_words, actual_words) if p == a)
+    def get(self, file_id):
+        return self.index.get(str(file_id))
 
-    # Рассчитываем точность как долю правильных слов от общего количества фактических слов
-    accuracy = correct_words / len(actual_words) if actual_words else 0
+transcripts = TranscriptStore()
+print(f"Загружено эталонных текстов: {len(transcripts)}")
 
-    # Рассчитываем точность и полноту
-    precision = correct_words / len(predicted_words) if predicted_words else 0
-    recall = correct_words / len(actual_words) if actual_words else 0
+# Утилитарные функции
+def calculate_similarity(predicted_text, actual_text):
+    # Оба текста нормализуются так же, как при обучении; метрики считаются функцией text_similarity
+    actual_text, predicted_text = text_transform.normalize_batch([actual_text, predicted_text])
+    return text_similarity(actual_text, predicted_text)
+
+# Бэкенды распознавания: у всех один интерфейс query(samples) -> {"text": ...},
+# где samples — моно float32 массив с частотой 16 кГц
+class RemoteRecognizer:
+    """Отправляет аудио в Hugging Face Inference API (или совместимую заглушку)"""
+    def __init__(self, api_url=API_URL, headers=headers):
+        self.api_url = api_url
+        self.headers = headers
+        self.model_version = f"remote:{api_url}"
+        # Переиспользуем соединения между запросами из разных потоков
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=RECOGNITION_WORKERS))
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=RECOGNITION_WORKERS))
+
+    def query(self, samples):
+        buffer = io.BytesIO()
+        sf.write(buffer, samples, 16000, format="WAV", subtype="PCM_16")
+        data = buffer.getvalue()
+        with metrics.time("remote_request"):
+            response = self.session.post(self.api_url, headers=self.headers, data=data, timeout=REQUEST_TIMEOUT)
+        #print(f"Запрос к API отправлен на {self.api_url} с кодом состояния: {response.status_code}")
+        try:
+            return response.json()
+        except ValueError:  # Например, HTML-страница ошибки от прокси
+            return {"error": f"HTTP {response.status_code}: {response.text[:200]}"}
+
+class LocalModelRecognizer:
+    """Распознает речь нашей обученной моделью SpeechRecognitionModel1 на CPU"""
+    def __init__(self, checkpoint_path=MODEL_CHECKPOINT_PATH, n_class=34, decoder=DECODER,
+                 quantized_path=QUANTIZED_MODEL_PATH):
+        if quantized_path is not None:
+            self.model = torch.jit.load(quantized_path)
+            checkpoint_path = quantized_path
+        else:
+            self.model = SpeechRecognitionModel1(n_class)
+            checkpoint = torch.load(checkpoint_path, map_location="cpu")
+            self.model.load_state_dict(checkpoint['model_state_dict'])
+        self.model.eval()
+        self.decoder = decoder
+        self.lm = None
+        if decoder == "beam" and USE_CHAR_LM:
+            self.lm = CharNgramLM.load(CHAR_LM_PATH)
+        self.model_version = f"local_model:{checkpoint_path}:{os.path.getmtime(checkpoint_path)}:{decoder}"
+
+    def _decode(self, log_probs):
+        """Декодирует (time, n_class) log-вероятности одной записи"""
+        if self.decoder == "beam":
+            return ctc_prefix_beam_search(log_probs, BEAM_WIDTH, lm=self.lm, lm_weight=LM_WEIGHT,
+                                          insertion_bonus=LM_INSERTION_BONUS if self.lm is not None else 0.0)
+        return decode_predictions(log_probs.unsqueeze(0))[0]
+
+    def query(self, samples):
+        return self.query_batch([samples])[0]
+
+    def query_batch(self, batch):
+        outputs = [None] * len(batch)
+
+        # Длинные записи распознаем по частям, чтобы память не росла с длиной записи
+        short = []
+        for i, samples in enumerate(batch):
+            if len(samples) > CHUNK_SECONDS * 16000:
+                with metrics.time("forward_chunked"):
+                    log_probs = chunked_log_probs(self.model, samples)
+                with metrics.time("ctc_decode"):
+                    outputs[i] = {"text": self._decode(log_probs)}
+            else:
+                short.append(i)
+        if not short:
+            return outputs
+
+        spectrograms = []
+        with metrics.time("features"):
+            for i in short:
+                waveform = torch.from_numpy(batch[i]).unsqueeze(0)  # Без копирования данных
+                spectrograms.append(valid_audio_transforms(waveform).squeeze(0).transpose(0, 1))
+        # Результат каждой записи не зависит от того, с какими записями она попала в батч
+        with metrics.time("forward"):
+            log_probs = batch_log_probs(self.model, spectrograms)
+        with metrics.time("ctc_decode"):
+            if self.decoder == "beam":
+                texts = [self._decode(output) for output in log_probs]
+            else:
+                texts = decode_predictions(nn.utils.rnn.pad_sequence(log_probs, batch_first=True),
+                                           [len(output) for output in log_probs])
+        for i, text in zip(short, texts):
+            outputs[i] = {"text": text}
+        return outputs
+
+class Wav2Vec2Recognizer:
+    """Распознает речь локально сохраненной моделью wav2vec2 на CPU"""
+    def __init__(self, model_path=WAV2VEC2_MODEL_PATH):
+        from transformers import Wav2Vec2ForCTC, Wav2Vec2Processor  # Устанавливается вместе с huggingsound
+        self.processor = Wav2Vec2Processor.from_pretrained(model_path)
+        self.model = Wav2Vec2ForCTC.from_pretrained(model_path)
+        self.model.eval()
+        self.model_version = f"local_wav2vec2:{model_path}"
+
+    def query(self, samples):
+        with metrics.time("features"):
+            inputs = self.processor(samples, sampling_rate=16000, return_tensors="pt")
+        with metrics.time("forward"), torch.no_grad():
+            logits = self.model(inputs.input_values).logits
+        with metrics.time("ctc_decode"):
+            return {"text": self.processor.batch_decode(torch.argmax(logits, dim=-1))[0]}
+
+RECOGNIZERS = {
+    "remote": RemoteRecognizer,
+    "local_model": LocalModelRecognizer,
+    "local_wav2vec2": Wav2Vec2Recognizer,
+}
+
+def create_recognizer(backend=RECOGNIZER_BACKEND):
+    if backend not in RECOGNIZERS:
+        raise ValueError(f"Неизвестный бэкенд распознавания: {backend}")
+    return RECOGNIZERS[backend]()
+
+recognizer = create_recognizer()
+
+def query(samples):
+    return recognizer.query(samples)
+
+# Распознавание выполняется в пуле потоков, чтобы не блокировать цикл событий бота
+recognition_executor = ThreadPoolExecutor(max_workers=RECOGNITION_WORKERS)
+in_flight = 0  # Меняется только из цикла событий, поэтому блокировка не нужна
+
+class BatchingScheduler:
+    """Собирает одновременные запросы в батч и распознает их одним проходом модели"""
+    def __init__(self, recognizer, executor, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_BATCH_WAIT_MS):
+        self.recognizer = recognizer
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue_time_ms = Histogram([1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000])
+        self.batch_size = Histogram(range(1, max_batch_size + 1))
+        self._queue = None
+        self._task = None
+
+    async def submit(self, samples):
+        loop = asyncio.get_running_loop()
+        if self._task is None:  # Запускаем обработчик очереди в цикле событий бота
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        await self._queue.put((samples, time.perf_counter(), future))
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            # Запросы, которые уже отменены по таймауту, не распознаем
+            batch = [item for item in batch if not item[2].done()]
+            if not batch:
+                continue
+
+            now = time.perf_counter()
+            for _, queued_at, _ in batch:
+                self.queue_time_ms.observe((now - queued_at) * 1000)
+                metrics.observe("batch_queue", (now - queued_at) * 1000)
+            self.batch_size.observe(len(batch))
+
+            audios = [samples for samples, _, _ in batch]
+            try:
+                outputs = await loop.run_in_executor(self.executor, self.recognizer.query_batch, audios)
+            except Exception as e:
+                outputs = [e] * len(batch)
+            for (_, _, future), output in zip(batch, outputs):
+                if future.done():
+                    continue
+                if isinstance(output, Exception):
+                    future.set_exception(output)
+                else:
+                    future.set_result(output)
 
-    return accuracy, precision, recall
+    def stats(self):
+        return (f"Время в очереди, мс: {self.queue_time_ms.summary()}\n"
+                f"Размер батча: {self.batch_size.summary()}")
 
-def calculate_levenshtein_accuracy(predicted_text, actual_text):
-    return fuzz.ratio(predicted_text, actual_text) / 100  # Нормализовано до [0, 1]
+class ResultCache:
+    """LRU-кэш распознанных текстов по file_unique_id Telegram или хэшу аудио с версией модели в ключе.
 
-def query(filename):
-    with open(filename, "rb") as f:
-        data = f.read()
-    response = requests.post(API_URL, headers=headers, data=data)
-    #print(f"Запрос к API отправлен на {API_URL} с кодом состояния: {response.status_code}")
-    return response.json()
+    Диск — второй уровень кэша, ограниченный max_disk_items файлами. Чтение и запись файлов
+    выполняются в пуле потоков, чтобы не блокировать цикл событий бота.
+    """
+    def __init__(self, model_version, max_items=RESULT_CACHE_SIZE, cache_dir=RESULT_CACHE_DIR,
+                 max_disk_items=RESULT_CACHE_DISK_ITEMS):
+        self.model_version = model_version
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.max_disk_items = max_disk_items
+        self.items = OrderedDict()
+        self.disk = OrderedDict()  # Ключи файлов на диске, от давно запрошенных к недавним
+        self.hits = 0
+        self.misses = 0  # Сколько результатов пришлось получить от модели
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            files = [entry for entry in os.scandir(cache_dir) if entry.name.endswith(".json")]
+            for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+                self.disk[entry.name[:-len(".json")]] = None
+
+    def _key(self, key):
+        return hashlib.sha1(f"{self.model_version}|{key}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _remember(self, key, output):
+        self.items[key] = output
+        self.items.move_to_end(key)
+        if len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                output = json.load(f)
+            os.utime(self._path(key))  # Порядок вытеснения сохраняется между перезапусками
+            return output
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, keys, output, evicted):
+        for key in keys:
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(output, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+        for key in evicted:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    async def get(self, key):
+        key = self._key(key)
+        output = self.items.get(key)
+        if output is not None:
+            self.items.move_to_end(key)
+        elif key in self.disk:
+            output = await asyncio.get_running_loop().run_in_executor(None, self._read, key)
+            if output is not None:
+                self._remember(key, output)
+                self.disk.move_to_end(key)
+            else:
+                del self.disk[key]
+        if output is not None:
+            self.hits += 1
+        return output
+
+    async def put(self, output, *keys, from_model=True):
+        if from_model:
+            self.misses += 1
+        keys = [self._key(key) for key in keys]
+        for key in keys:
+            self._remember(key, output)
+        if self.cache_dir is None:
+            return
+        for key in keys:
+            self.disk[key] = None
+            self.disk.move_to_end(key)
+        evicted = []
+        while len(self.disk) > self.max_disk_items:
+            evicted.append(self.disk.popitem(last=False)[0])
+        await asyncio.get_running_loop().run_in_executor(None, self._write, keys, output, evicted)
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        return (f"Кэш результатов: попаданий {self.hits}, промахов {self.misses} ({hit_rate:.0%} попаданий), "
+                f"на диске {len(self.disk)}")
+
+def result_cache_version(recognizer):
+    # Результат зависит не только от модели, но и от подготовки аудио и декодирования
+    lm_mtime = os.path.getmtime(CHAR_LM_PATH) if os.path.exists(CHAR_LM_PATH) else None
+    settings = {
+        "model": recognizer.model_version,
+        "vad": vad_params if VAD_ENABLED else None,
+        "mel": mel_params,
+        "chunk": [CHUNK_SECONDS, CHUNK_OVERLAP_SECONDS],
+        "decoder": [DECODER, BEAM_WIDTH, USE_CHAR_LM, LM_WEIGHT, LM_INSERTION_BONUS, lm_mtime],
+    }
+    return json.dumps(settings, sort_keys=True)
+
+result_cache = ResultCache(result_cache_version(recognizer))
+
+batcher = None
+if BATCHING_ENABLED and hasattr(recognizer, "query_batch"):
+    batcher = BatchingScheduler(recognizer, recognition_executor)
+
+def prepare_audio(audio_bytes):
+    # Декодирование и та же обрезка тишины, что и при обучении (VAD_ENABLED, vad_params)
+    with metrics.time("audio_decode"):
+        samples = load_audio_bytes(audio_bytes)
+    if not VAD_ENABLED:
+        return samples
+    with metrics.time("vad"):
+        return remove_silence(samples)
+
+async def recognize(audio_bytes):
+    loop = asyncio.get_running_loop()
+    # Декодируем прямо из памяти в пуле потоков
+    samples = await loop.run_in_executor(recognition_executor, prepare_audio, audio_bytes)
+    if batcher is not None:
+        return await batcher.submit(samples)
+    return await loop.run_in_executor(recognition_executor, query, samples)
+
+async def transcribe(audio_bytes):
+    return await asyncio.wait_for(recognize(audio_bytes), timeout=REQUEST_TIMEOUT)
 
 # Обработчики Telegram бота
 async def start(update: Update, context: CallbackContext):
-    await update.message.reply_text("Здравствуйте! Отправьте мне файл аудио .wav, и я постараюсь распознать речь!")
+    await update.message.reply_text(
+        "Здравствуйте! Отправьте мне голосовое сообщение или аудиофайл, и я постараюсь распознать речь!\n"
+        "Чтобы сравнить с эталоном, укажите id фразы в подписи к аудио или командой /id <номер>."
+    )
+
+async def set_reference_id(update: Update, context: CallbackContext):
+    # id эталонной фразы для следующих аудио этого пользователя
+    if not context.args:
+        await update.message.reply_text("Укажите id фразы, например: /id 12")
+        return
+    context.user_data["reference_id"] = context.args[0]
+    await update.message.reply_text(f"Следующие аудио будут сравниваться с фразой {context.args[0]}.")
+
+def get_reference_id(update: Update, context: CallbackContext):
+    """id эталона: из подписи к аудио, иначе из команды /id, иначе из имени файла вида 12.wav"""
+    caption = (update.message.caption or "").split()
+    if caption:
+        return caption[0]
+    if context is not None and context.user_data.get("reference_id") is not None:
+        return context.user_data["reference_id"]
+    file_name = getattr(update.message.audio, "file_name", None)
+    if file_name:
+        return os.path.splitext(file_name)[0]
+    return None
+
+async def stats(update: Update, context: CallbackContext):
+    if batcher is None:
+        batching_stats = "Объединение запросов в батчи отключено."
+    else:
+        batching_stats = batcher.stats()
+    reply = f"{batching_stats}\n{result_cache.stats()}"
+    if metrics.enabled:
+        reply += f"\n{metrics.summary()}"
+    await update.message.reply_text(reply)
 
 async def handle_audio(update: Update, context: CallbackContext):
+    global in_flight
     print("Аудиофайл получен!")
 
-    if update.message.audio:
-        audio_file = await update.message.audio.get_file()
-
-        # Получаем file_id и используем его для создания имени файла
-        audio_id = update.message.audio.file_id  # Определяем audio_id здесь
-        original_filename = update.message.audio.file_name  # Получаем оригинальное имя файла
-        wav_file_path = original_filename  # Используем оригинальное имя файла для сохранения
+    if in_flight >= MAX_IN_FLIGHT:
+        print("Очередь распознавания заполнена, запрос отклонен.")
+        await update.message.reply_text("Сейчас много запросов, пожалуйста, отправьте аудио еще раз через минуту.")
+        return
 
-        # Выводим file_id и предполагаемое имя файла
-        print(f"Получен аудиофайл с file_id: {audio_id}")
-        print(f"Оригинальное имя файла для аудио: {original_filename}")
+    in_flight += 1
+    try:
+        with metrics.time("request"):
+            await process_audio(update, context)
+    finally:
+        in_flight -= 1
+
+async def process_audio(update: Update, context: CallbackContext):
+    # Голосовое сообщение (OGG/Opus) или аудиофайл
+    media = update.message.voice or update.message.audio
+    if media:
+        audio_id = media.file_id
+        unique_id = media.file_unique_id  # Одинаков для повторно присланного файла
+        reference_id = get_reference_id(update, context)
+
+        print(f"Получено {'голосовое сообщение' if update.message.voice else 'аудио'} с file_id: {audio_id}")
+        print(f"id эталонной фразы: {reference_id}")
 
         try:
-            await audio_file.download_to_drive(wav_file_path)
-            print(f"Аудиофайл сохранен как {wav_file_path}")
-
-            # Используем предполагаемое имя файла для обработки
-            output = query(wav_file_path)
+            # Повторно присланный файл отвечаем из кэша без скачивания и распознавания
+            output = await result_cache.get(unique_id)
+            if output is None:
+                # Скачиваем аудио в память, на диск ничего не пишется
+                with metrics.time("download"):
+                    audio_file = await media.get_file()
+                    audio_bytes = bytes(await audio_file.download_as_bytearray())
+                print(f"Аудиофайл загружен в память: {len(audio_bytes)} байт")
+
+                # Та же запись могла прийти как другой файл Telegram
+                content_hash = hashlib.sha1(audio_bytes).hexdigest()
+                output = await result_cache.get(content_hash)
+                if output is not None:
+                    await result_cache.put(output, unique_id, from_model=False)
+                else:
+                    output = await transcribe(audio_bytes)
+                    if "text" in output:
+                        await result_cache.put(output, unique_id, content_hash)
+            else:
+                print("Результат взят из кэша.")
             print(f"Ответ Модель: {output}")
 
             if "text" in output:
                 predicted_text = output["text"]
                 print(f"Предсказанный текст: {predicted_text}")
 
-                # Извлекаем ID из оригинального имени файла
-                extracted_id = original_filename.split('.')[0]  # Получаем ID (например, "1" из "1.wav")
-
-                # Сравниваем extracted_id с 'id' в DataFrame
-                actual_text = df.loc[df['id'] == extracted_id, 'text'].values
-                if actual_text.size > 0:
-                    actual_text = actual_text[0]
-
-                    # Рассчитываем метрики точности
-                    accuracy, precision, recall = calculate_accuracy(predicted_text, actual_text)
-                    levenshtein_accuracy = calculate_levenshtein_accuracy(predicted_text, actual_text)
-
-                    await update.message.reply_text(
+                # Ищем эталонный текст по id из подписи, команды /id или имени файла
+                actual_text = transcripts.get(reference_id) if reference_id is not None else None
+                if actual_text is not None:
+                    # Рассчитываем метрики точности и выравнивание по словам
+                    similarity = calculate_similarity(predicted_text, actual_text)
+                    reply = (
                         f"Предсказанный текст: {predicted_text}\n"
                         f"Фактический текст: {actual_text}\n"
-                        f"Точность: {levenshtein_accuracy:.2%}"
+                        f"Точность: {similarity['ratio']:.2%}"
                     )
+                    if similarity['word_errors']:
+                        reply += f"\nОшибки: {format_alignment(similarity['alignment'])}"
+                    with metrics.time("reply"):
+                        await update.message.reply_text(reply)
                 else:
                     print("Не найдено фактической транскрипции для этого аудиофайла.")
-                    await update.message.reply_text("Не найдено фактической транскрипции для этого аудиофайла.")
+                    await update.message.reply_text(
+                        f"Предсказанный текст: {predicted_text}\n"
+                        "Не найдено фактической транскрипции для этого аудиофайла. "
+                        "Укажите id фразы в подписи к аудио или командой /id <номер>."
+                    )
             else:
                 print("Ошибка: Транскрипция не возвращена от API.")
                 await update.message.reply_text("Ошибка: Транскрипция не возвращена от API.")
 
+        except asyncio.TimeoutError:
+            print(f"Распознавание не уложилось в {REQUEST_TIMEOUT} с.")
+            await update.message.reply_text("Распознавание заняло слишком много времени, попробуйте еще раз позже.")
         except Exception as e:
             print(f"Ошибка во время обработки аудио: {e}")
             await update.message.reply_text("Произошла ошибка при обработке вашего аудиофайла.")
@@ -734,14 +2796,403 @@ async def handle_audio(update: Update, context: CallbackContext):
         print("В сообщении не найден аудиофайл.")
         await update.message.reply_text("Пожалуйста, отправьте действительный аудиофайл.")
 
+"""**Пакетная оценка записей без бота**
+
+Распознает все записи {id}.wav (.ogg, .flac) в папках дикторов тем же recognizer, что и бот,
+и сравнивает их с эталонами из Data.xlsx. Записи декодируются в пуле потоков, следующий батч
+готовится, пока распознается текущий. Строки пишутся в CSV после каждого батча, поэтому
+прерванную оценку можно запустить снова: уже оцененные (диктор, id) пропускаются.
+Ошибка декодирования или распознавания одной записи не прерывает оценку: запись выводится
+в лог, не попадает в CSV и оценивается заново при следующем запуске.
+По окончании рядом сохраняется сводка по дикторам и по всему набору (_summary.csv).
+"""
+
+import csv
+
+# Папки дикторов, например [r"/content/drive/MyDrive/Dataset_PC/RSDA Dataset v5/Speaker_3"]; None — оценка не запускается
+EVALUATION_SPEAKER_DIRS = None
+EVALUATION_EXCEL_PATH = "/content/Data.xlsx"
+EVALUATION_REPORT_PATH = "/content/evaluation.csv"
+EVALUATION_BATCH_SIZE = MAX_BATCH_SIZE
+
+REPORT_COLUMNS = ["speaker", "id", "path", "seconds", "reference", "prediction", "words", "word_errors", "wer",
+                  "chars", "char_errors", "cer", "levenshtein_accuracy", "word_accuracy"]
+
+def prepare_file(path):
+    # Та же подготовка, что и для аудио из Telegram
+    samples = load_audio(path)
+    return remove_silence(samples) if VAD_ENABLED else samples
+
+def _query_file(samples):
+    # Ошибка одной записи (таймаут, ответ не JSON) возвращается как результат, а не прерывает батч
+    try:
+        return recognizer.query(samples)
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
+def _recognize_batch(samples, pool):
+    """Результаты для батча, в котором вместо недекодированных записей лежат исключения"""
+    outputs = [{"error": f"{type(audio).__name__}: {audio}"} if isinstance(audio, Exception) else None
+               for audio in samples]
+    decoded = [i for i, audio in enumerate(samples) if not isinstance(audio, Exception)]
+    audios = [samples[i] for i in decoded]
+    results = None
+    if hasattr(recognizer, "query_batch"):
+        try:
+            results = recognizer.query_batch(audios)
+        except Exception as e:
+            print(f"Батч не распознан ({e}), распознаем записи по одной")
+    if results is None:
+        results = list(pool.map(_query_file, audios))
+    for i, output in zip(decoded, results):
+        outputs[i] = output
+    return outputs
+
+def _scored_keys(report_path):
+    if not os.path.exists(report_path):
+        return set()
+    report = pd.read_csv(report_path, dtype={"speaker": str, "id": str}, keep_default_na=False,
+                         on_bad_lines="skip")
+    report = report[report["word_accuracy"] != ""]  # Строка, оборванная при прерывании, оценивается заново
+    return set(zip(report["speaker"], report["id"]))
+
+def _evaluation_tasks(speaker_dirs, references, done):
+    tasks = []
+    for speaker_dir in speaker_dirs:
+        speaker = os.path.basename(os.path.normpath(speaker_dir))
+        for file_name in sorted(os.listdir(speaker_dir)):
+            file_id, ext = os.path.splitext(file_name)
+            reference = references.get(file_id)
+            has_reference = isinstance(reference, str) and reference.strip()
+            if ext.lower() in (".wav", ".ogg", ".flac") and has_reference and (speaker, file_id) not in done:
+                tasks.append((speaker, file_id, os.path.join(speaker_dir, file_name)))
+    return tasks
+
+def _score_batch(batch, samples, outputs, references):
+    rows = []
+    for (speaker, file_id, path), audio, output in zip(batch, samples, outputs):
+        if not isinstance(output, dict) or "text" not in output:
+            print(f"{speaker}/{file_id}: распознавание не удалось ({output}), повторим при следующем запуске")
+            continue
+        rows.append({"speaker": speaker, "id": file_id, "path": path, "seconds": len(audio) / 16000,
+                     "reference": references.get(file_id), "prediction": output["text"]})
+    if not rows:
+        return rows
+
+    for row in rows:
+        similarity = calculate_similarity(row["prediction"], row["reference"])
+        row.update({column: similarity[column] for column in ("words", "word_errors", "wer", "chars",
+                                                               "char_errors", "cer", "word_accuracy")},
+                   levenshtein_accuracy=similarity["ratio"])
+    return rows
+
+def summarize_report(report_path):
+    """WER/CER по каждому диктору и по всему набору (ошибки суммируются, а не усредняются по файлам)"""
+    report = pd.read_csv(report_path, dtype={"speaker": str, "id": str})
+    report = report.dropna(subset=["word_accuracy"]).drop_duplicates(["speaker", "id"], keep="last")
+    groups = list(report.groupby("speaker")) + [("ALL", report)]
+    summary = pd.DataFrame([{
+        "speaker": speaker,
+        "files": len(rows),
+        "hours": rows["seconds"].sum() / 3600,
+        "wer": rows["word_errors"].sum() / max(1, rows["words"].sum()),
+        "cer": rows["char_errors"].sum() / max(1, rows["chars"].sum()),
+        "levenshtein_accuracy": rows["levenshtein_accuracy"].mean(),
+        "word_accuracy": rows["word_accuracy"].mean(),
+    } for speaker, rows in groups])
+    summary.to_csv(os.path.splitext(report_path)[0] + "_summary.csv", index=False)
+    print(summary.to_string(index=False))
+    return summary
+
+def score_dataset(speaker_dirs, excel_path=EVALUATION_EXCEL_PATH, report_path=EVALUATION_REPORT_PATH,
+                  batch_size=EVALUATION_BATCH_SIZE, workers=RECOGNITION_WORKERS):
+    references = TranscriptStore(excel_path, os.path.splitext(excel_path)[0] + ".pkl")
+    tasks = _evaluation_tasks(speaker_dirs, references, _scored_keys(report_path))
+    print(f"К оценке {len(tasks)} записей, результаты дописываются в {report_path}")
+
+    # Хвост файла, оборванный на середине строки, закрываем переводом строки
+    new_file = not os.path.exists(report_path) or os.path.getsize(report_path) == 0
+    if not new_file:
+        with open(report_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+        if needs_newline:
+            with open(report_path, "a", encoding="utf-8") as f:
+                f.write("\n")
+
+    batches = [tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size)]
+    start, scored, failed = time.perf_counter(), 0, 0
+    with ThreadPoolExecutor(max_workers=workers) as pool, \
+            open(report_path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS)
+        if new_file:
+            writer.writeheader()
+        pending = [pool.submit(prepare_file, path) for _, _, path in batches[0]] if batches else []
+        for b, batch in enumerate(batches):
+            samples = [future.exception() or future.result() for future in pending]
+            if b + 1 < len(batches):  # Декодируем следующий батч во время распознавания текущего
+                pending = [pool.submit(prepare_file, path) for _, _, path in batches[b + 1]]
+            outputs = _recognize_batch(samples, pool)
+
+            rows = _score_batch(batch, samples, outputs, references)
+            writer.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+            scored += len(rows)
+            failed += len(batch) - len(rows)
+            print(f"Оценено {scored}/{len(tasks)} записей, {scored / (time.perf_counter() - start):.1f} записей/с")
+
+    if failed:
+        print(f"Не удалось оценить {failed} записей, они будут оценены при следующем запуске")
+    return summarize_report(report_path) if os.path.exists(report_path) else None
+
+if EVALUATION_SPEAKER_DIRS is not None:
+    score_dataset(EVALUATION_SPEAKER_DIRS)
+
+"""**Бенчмарки горячих путей обучения и бота**
+
+Все данные синтетические (шум вместо речи, случайные тексты), Google Drive и сеть не нужны.
+Результаты сохраняются в JSON, чтобы сравнивать их между коммитами через compare_benchmarks.
+Без выполнения всего скрипта (Drive, Excel, обучение): python benchmarks.py results.json [--baseline old.json]
+"""
+
+import contextlib
+import subprocess
+import tempfile
+import types
+
+BENCHMARK_RESULTS_PATH = None  # Например "/content/benchmarks.json"; None — бенчмарки не запускаются
+
+def _timeit(fn, repeat=5, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {"mean_ms": float(np.mean(times)), "median_ms": float(np.median(times)),
+            "min_ms": float(np.min(times)), "repeat": repeat}
+
+def _synthetic_text(rng, n_words):
+    letters = list("абвгдежзийклмнопрстуфхцчшщъыьэюя")
+    return " ".join("".join(rng.choice(letters, size=rng.integers(2, 9))) for _ in range(n_words))
+
+def _synthetic_audio(rng, seconds, sr=16000):
+    return (rng.standard_normal(int(seconds * sr)) * 0.1).astype(np.float32)
+
+class _StubRecognizer:
+    model_version = "stub"
+
+    def query(self, samples):
+        return {"text": "мама мыла раму"}
+
+class _StubTranscripts:
+    """Таблица эталонных текстов без Excel, с тем же интерфейсом, что у TranscriptStore"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, file_id):
+        return self.index.get(str(file_id))
+
+def _fake_update(audio_bytes, file_name, unique_id, caption=None, voice=False):
+    async def download_as_bytearray():
+        return bytearray(audio_bytes)
+
+    async def get_file():
+        return types.SimpleNamespace(download_as_bytearray=download_as_bytearray)
+
+    async def reply_text(text):
+        pass
+
+    media = types.SimpleNamespace(file_id=unique_id, file_unique_id=unique_id, get_file=get_file)
+    if not voice:
+        media.file_name = file_name
+    message = types.SimpleNamespace(audio=None if voice else media, voice=media if voice else None,
+                                    caption=caption, reply_text=reply_text)
+    return types.SimpleNamespace(message=message)
+
+def _librosa_decode(audio_bytes, suffix):
+    # Прежний путь: файл на диске и librosa.load (audioread/ffmpeg, если libsndfile не справился)
+    with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+        f.write(audio_bytes)
+        f.flush()
+        return librosa.load(f.name, sr=16000)[0]
+
+def run_benchmarks(output_path, batch_sizes=(1, 4, 8), durations=(2, 5, 10), repeat=5):
+    global recognizer, batcher, result_cache, transcripts
+    rng = np.random.default_rng(0)
+    results = {}
+
+    # Расстояние Левенштейна и метрики
+    refs = [_synthetic_text(rng, 8) for _ in range(64)]
+    hyps = [_synthetic_text(rng, 8) for _ in range(64)]
+    results["levenshtein_200_chars"] = _timeit(lambda: _levenshtein_distance(refs[0] * 4, hyps[0] * 4), repeat)
+    results["edit_distance_200_chars"] = _timeit(lambda: edit_distance(refs[0] * 4, hyps[0] * 4), repeat)
+    results["text_similarity_64_pairs"] = _timeit(lambda: [text_similarity(r, h) for r, h in zip(refs, hyps)],
+                                                  repeat)
+    results["wer_64_pairs"] = _timeit(lambda: [wer(r, h) for r, h in zip(refs, hyps)], repeat)
+    results["cer_64_pairs"] = _timeit(lambda: [cer(r, h) for r, h in zip(refs, hyps)], repeat)
+    results["batch_cer_64_pairs"] = _timeit(lambda: batch_cer(refs, hyps), repeat)
+    results["batch_wer_64_pairs"] = _timeit(lambda: batch_wer(refs, hyps), repeat)
+
+    # Подготовка данных
+    results["text_to_int_64_texts"] = _timeit(lambda: [text_transform.text_to_int(r) for r in refs], repeat)
+    results["encode_batch_64_texts"] = _timeit(lambda: text_transform.encode_batch(refs), repeat)
+    batch = [(torch.from_numpy(_synthetic_audio(rng, 5)).unsqueeze(0), refs[i]) for i in range(10)]
+    results["data_processing_train_10x5s"] = _timeit(lambda: data_processing(batch, 'train'), repeat)
+    results["data_processing_valid_10x5s"] = _timeit(lambda: data_processing(batch, 'valid'), repeat)
+
+    # Декодирование
+    output = torch.randn(10, 250, 34).log_softmax(dim=2)
+    labels = torch.randint(0, 33, (10, 40)).float()
+    results["greedy_decoder_10x250"] = _timeit(lambda: GreedyDecoder(output, labels, [40] * 10), repeat)
+
+    # Проверки корректности на модели с фиксированными весами
+    torch.manual_seed(0)
+    check_model = SpeechRecognitionModel1(34).eval()
+    recordings = [_synthetic_audio(rng, seconds) for seconds in (1.3, 2, 3.7)]
+    checks = {"batched_vs_single_max_diff": check_batched_recognition(check_model, recordings)}
+    # Окна по 5 с, чтобы 12-секундная запись распознавалась по частям
+    long_recording = _synthetic_audio(rng, 12)
+    checks["chunked_vs_full_cer"] = check_chunked_recognition(check_model, [long_recording], chunk_seconds=5,
+                                                              overlap_seconds=2)
+    results["full_log_probs_12s"] = _timeit(lambda: full_log_probs(check_model, long_recording), repeat)
+    results["chunked_log_probs_12s"] = _timeit(
+        lambda: chunked_log_probs(check_model, long_recording, chunk_seconds=5, overlap_seconds=2), repeat)
+    spectrograms = [valid_audio_transforms(torch.from_numpy(samples).unsqueeze(0)).squeeze(0).transpose(0, 1)
+                    for samples in recordings]
+    results["batch_log_probs_3_recordings"] = _timeit(lambda: batch_log_probs(check_model, spectrograms), repeat)
+
+    # CTC beam search по log-вероятностям 5-секундной записи, без LM и с символьной LM на синтетических текстах
+    beam_log_probs = full_log_probs(check_model, _synthetic_audio(rng, 5))
+    beam_lm = CharNgramLM.build(refs)
+    for beam_width in (1, 4, 8, 16):
+        results[f"beam_search_w{beam_width}_5s"] = _timeit(
+            lambda: ctc_prefix_beam_search(beam_log_probs, beam_width), repeat)
+        results[f"beam_search_w{beam_width}_lm_5s"] = _timeit(
+            lambda: ctc_prefix_beam_search(beam_log_probs, beam_width, lm=beam_lm, lm_weight=LM_WEIGHT,
+                                           insertion_bonus=LM_INSERTION_BONUS), repeat)
+
+    # Прямой и обратный проход модели на CPU
+    model = SpeechRecognitionModel1(34)
+    criterion = nn.CTCLoss(blank=28)
+    for batch_size in batch_sizes:
+        for seconds in durations:
+            spectrograms, labels, input_lengths, label_lengths = data_processing(
+                [(torch.from_numpy(_synthetic_audio(rng, seconds)).unsqueeze(0), refs[i][:20])
+                 for i in range(batch_size)], 'valid')
+
+            def forward():
+                model.eval()
+                with torch.no_grad():
+                    model(spectrograms)
+
+            def forward_backward():
+                model.train()
+                model.zero_grad()
+                output = F.log_softmax(model(spectrograms), dim=2).transpose(0, 1)
+                criterion(output, labels, input_lengths, label_lengths).backward()
+
+            results[f"model_forward_b{batch_size}_{seconds}s"] = _timeit(forward, repeat)
+            results[f"model_forward_backward_b{batch_size}_{seconds}s"] = _timeit(forward_backward, repeat)
+
+    # Декодирование голосового сообщения (OGG/Opus 48 кГц) в 16 кГц: в памяти против librosa через файл
+    ogg_buffer = io.BytesIO()
+    sf.write(ogg_buffer, _synthetic_audio(rng, 5, sr=48000), 48000, format="OGG", subtype="OPUS")
+    results["decode_voice_ogg_opus_5s"] = _timeit(lambda: load_audio_bytes(ogg_buffer.getvalue()), repeat)
+    results["decode_voice_ogg_opus_5s_librosa"] = _timeit(lambda: _librosa_decode(ogg_buffer.getvalue(), ".ogg"),
+                                                          repeat)
+
+    # Бот целиком: загрузка, декодирование, распознавание заглушкой, поиск эталона, ответ
+    wav_buffer = io.BytesIO()
+    sf.write(wav_buffer, _synthetic_audio(rng, 5), 16000, format="WAV")
+    file_id = "1"
+    saved = recognizer, batcher, result_cache, transcripts
+    recognizer, batcher, result_cache = _StubRecognizer(), None, ResultCache("stub", max_items=0, cache_dir=None)
+    transcripts = _StubTranscripts({file_id: refs[0]})
+    try:
+        def bot_round_trip():
+            with contextlib.redirect_stdout(io.StringIO()):
+                asyncio.run(handle_audio(_fake_update(wav_buffer.getvalue(), f"{file_id}.wav", "bench"), None))
+        results["bot_handle_audio_5s_stub"] = _timeit(bot_round_trip, repeat)
+
+        def bot_voice_round_trip():
+            with contextlib.redirect_stdout(io.StringIO()):
+                asyncio.run(handle_audio(_fake_update(ogg_buffer.getvalue(), None, "bench-voice", caption=file_id,
+                                                      voice=True), None))
+        results["bot_handle_voice_5s_stub"] = _timeit(bot_voice_round_trip, repeat)
+    finally:
+        recognizer, batcher, result_cache, transcripts = saved
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    report = {"meta": {"commit": commit, "torch": torch.__version__, "threads": torch.get_num_threads(),
+                       "time": time.strftime("%Y-%m-%d %H:%M:%S")},
+              "checks": checks, "results": results}
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+    for name, row in results.items():
+        print(f"{name:45s} {row['median_ms']:10.2f} мс")
+    return report
+
+def compare_benchmarks(baseline_path, current_path, threshold=1.10):
+    """Печатает отношение времен двух прогонов и возвращает бенчмарки, ставшие медленнее threshold"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    with open(current_path) as f:
+        current = json.load(f)["results"]
+    regressions = []
+    for name in sorted(set(baseline) & set(current)):
+        ratio = current[name]["median_ms"] / baseline[name]["median_ms"]
+        if ratio > threshold:
+            regressions.append(name)
+        print(f"{name:45s} {ratio:6.2f}x{'  <-- медленнее' if ratio > threshold else ''}")
+    return regressions
+
+if BENCHMARK_RESULTS_PATH is not None:
+    run_benchmarks(BENCHMARK_RESULTS_PATH)
+
+# HTTP endpoint для Prometheus
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Не засоряем вывод бота запросами Prometheus
+
+def start_metrics_server(port=METRICS_PORT):
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Метрики доступны на http://0.0.0.0:{port}/metrics")
+    return server
+
 # Основная функция
 def main():
-    # Создаем приложение
-    app = Application.builder().token(TOKEN).build()
+    # Создаем приложение; обновления от разных пользователей обрабатываются параллельно
+    app = Application.builder().token(TOKEN).concurrent_updates(True).build()
+    if METRICS_PORT is not None:
+        start_metrics_server()
 
     # Регистрируем обработчики команд и сообщений
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.AUDIO, handle_audio))  # Слушаем аудиофайлы
+    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("id", set_reference_id))
+    app.add_handler(MessageHandler(filters.AUDIO | filters.VOICE, handle_audio))  # Слушаем аудиофайлы и голосовые
 
     # Запускаем бота в существующем цикле событий
     app.run_polling()
@@ -0,0 +1,64 @@
+"""Запуск бенчмарков из "Speech recognition.py" без выполнения всего скрипта.
+
+Из скрипта берутся только импорты, определения функций и классов, константы (имена в верхнем регистре)
+и несколько объектов уровня модуля, от которых зависят бенчмарки. Монтирование Google Drive, чтение
+Data.xlsx, манифест, кэш признаков, языковая модель, обучение и бот пропускаются.
+
+    python benchmarks.py results.json
+    python benchmarks.py results.json --baseline old.json  # код возврата 1 при регрессиях
+"""
+
+import argparse
+import ast
+import os
+import sys
+import types
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Speech recognition.py")
+SKIPPED_MODULES = ("google.colab",)  # Есть только в Colab
+# Объекты уровня модуля с именами в нижнем регистре, которые нужны бенчмаркам
+MODULE_OBJECTS = {"mel_params", "vad_params", "train_audio_transforms", "valid_audio_transforms",
+                  "train_feature_transforms", "valid_feature_transforms", "text_transform", "metrics",
+                  "headers", "recognition_executor", "in_flight"}
+
+def _is_definition(node):
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return True
+    if isinstance(node, ast.Import):
+        return not any(alias.name.startswith(SKIPPED_MODULES) for alias in node.names)
+    if isinstance(node, ast.ImportFrom):
+        return not (node.module or "").startswith(SKIPPED_MODULES)
+    if isinstance(node, ast.Assign):
+        return all(isinstance(target, ast.Name) and (target.id.isupper() or target.id in MODULE_OBJECTS)
+                   for target in node.targets)
+    return False
+
+def load_definitions(script_path=SCRIPT_PATH):
+    """Выполняет в отдельном модуле только определения из скрипта и возвращает этот модуль"""
+    with open(script_path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), script_path)
+    tree.body = [node for node in tree.body if _is_definition(node)]
+    module = types.ModuleType("speech_recognition")
+    module.__file__ = script_path
+    sys.modules[module.__name__] = module
+    exec(compile(tree, script_path, "exec"), module.__dict__)
+    return module
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки горячих путей обучения и бота на синтетических данных")
+    parser.add_argument("output", help="JSON-файл для результатов")
+    parser.add_argument("--baseline", help="JSON с результатами предыдущего запуска для сравнения")
+    parser.add_argument("--repeat", type=int, default=5, help="Число повторов каждого замера")
+    args = parser.parse_args()
+
+    sr = load_definitions()
+    # Глобальные объекты бота, которые run_benchmarks подменяет на время замеров
+    sr.recognizer, sr.batcher = sr._StubRecognizer(), None
+    sr.result_cache = sr.ResultCache("stub", max_items=0, cache_dir=None)
+    sr.transcripts = sr._StubTranscripts({})
+    sr.run_benchmarks(args.output, repeat=args.repeat)
+    if args.baseline:
+        sys.exit(1 if sr.compare_benchmarks(args.baseline, args.output) else 0)
+
+if __name__ == "__main__":
+    main()